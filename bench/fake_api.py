@@ -0,0 +1,236 @@
+import asyncio
+import base64
+import json
+import random
+from collections import Counter
+
+from aiohttp import web
+
+DRIVERS = [
+    "Lewis Hamilton", "Valtteri Bottas", "Max Verstappen", "Sergio Pérez", "Lando Norris",
+    "Daniel Ricciardo", "Charles Leclerc", "Carlos Sainz", "Pierre Gasly", "Yuki Tsunoda",
+    "Esteban Ocon", "Fernando Alonso", "Sebastian Vettel", "Lance Stroll", "Kimi Räikkönen",
+    "Antonio Giovinazzi", "George Russell", "Nicholas Latifi", "Mick Schumacher", "Nikita Mazepin",
+]
+TEAMS = ["Mercedes", "Red Bull", "McLaren", "Ferrari", "AlphaTauri", "Alpine", "Aston Martin", "Alfa Romeo", "Williams", "Haas"]
+DNF_REASONS = ["Crash", "Engine", "Gearbox", "Disconnect"]
+
+SEASON = {
+    "id": 1, "name": "Bench Season", "start_date": "2021-03-28", "end_date": "2021-12-12", "teams_disabled": False,
+}
+GAME_PERIOD = 7
+FANTASY_PLAYERS = 30
+
+
+class FakeAPI:
+    """Local stand-in for the F1 fantasy and results APIs with configurable latency and faults.
+
+    Latency applies to every request. Errors (500) and throttling (429 with Retry-After) are only
+    injected on the per-entrant and per-driver endpoints, which are the ones the bot retries.
+    """
+
+    def __init__(self, entrants=20, latency=0.0, error_rate=0.0, throttle_rate=0.0, races=12, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.races = races
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.runner = None
+        self.port = None
+        self.set_entrants(entrants)
+
+    def set_entrants(self, count):
+        self.scores = {user_id: 1000 - user_id for user_id in range(1, count + 1)}
+
+    def churn(self, fraction):
+        """Change the score of a fraction of the entrants so an incremental update has work to do."""
+        for user_id in self.random.sample(list(self.scores), int(len(self.scores) * fraction)):
+            self.scores[user_id] += self.random.randint(1, 25)
+
+    def reset_counters(self):
+        self.requests.clear()
+        self.statuses.clear()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def urls(self):
+        return {
+            "base_url": self.url,
+            "create_session_url": f"{self.url}/session",
+            "league_url": f"{self.url}/leagues?league_id={{league}}&page={{page}}&per_page={{size}}",
+            "user_url": f"{self.url}/users/{{}}",
+            "team_url": f"{self.url}/picked_teams/{{}}",
+            "events_url": f"{self.url}/players/{{}}/game_periods_scores",
+        }
+
+    async def start(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_post("/session", self.session, name="session")
+        app.router.add_get("/leagues", self.league, name="league")
+        app.router.add_get("/users/{id}", self.user, name="user")
+        app.router.add_get("/picked_teams/{id}", self.team, name="team")
+        app.router.add_get("/players/{id}/game_periods_scores", self.events, name="events")
+        app.router.add_get("/api/next-race", self.next_race, name="next-race")
+        app.router.add_get("/api/info/{division}", self.info, name="info")
+        app.router.add_get("/api/standings/{season}", self.standings, name="standings")
+        app.router.add_get("/api/races", self.schedule, name="races")
+        app.router.add_get("/api/results", self.results, name="results")
+        app.router.add_get("/api/stats", self.stats, name="stats")
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        name = request.match_info.route.name or "unmatched"
+        self.requests[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if name in ("user", "team", "events"):
+            roll = self.random.random()
+            if roll < self.throttle_rate:
+                response = web.Response(status=429, headers={"Retry-After": "1"})
+            elif roll < self.throttle_rate + self.error_rate:
+                response = web.Response(status=500)
+            else:
+                response = await handler(request)
+        else:
+            response = await handler(request)
+
+        self.statuses[response.status] += 1
+        return response
+
+    async def session(self, request):
+        claims = base64.urlsafe_b64encode(json.dumps({"exp": 4102444800}).encode()).decode().rstrip("=")
+        return web.json_response({"data": {"subscriptionToken": f"bench.{claims}.token"}})
+
+    async def league(self, request):
+        page = int(request.query.get("page", 1))
+        size = int(request.query.get("per_page", 100))
+        ranked = sorted(self.scores, key=self.scores.get, reverse=True)
+        entrants = [
+            {"user_id": user_id, "team_name": f"Team {user_id}", "score": self.scores[user_id], "rank": rank}
+            for rank, user_id in enumerate(ranked[(page - 1) * size:page * size], (page - 1) * size + 1)
+        ]
+        return web.json_response({"leaderboard": {"leaderboard_entrants": entrants}})
+
+    async def user(self, request):
+        user_id = int(request.match_info["id"])
+        return web.json_response({"user": {
+            "leaderboard_positions": {"slot_1": {"1": {"score": self.scores.get(user_id, 0)}}},
+            "historical_picked_teams_info": {"slot_1": {"historical_team_info": [
+                {"picked_team_id": user_id * 100 + period, "game_period_id": period}
+                for period in range(1, GAME_PERIOD + 1)
+            ]}},
+        }})
+
+    async def team(self, request):
+        team_id = int(request.match_info["id"])
+        picks = [(team_id + offset) % FANTASY_PLAYERS + 1 for offset in range(0, 15, 3)]
+        players = [self._pick(player_id, 1) for player_id in picks]
+        players.append(self._pick(team_id % 10 + 1, 2))
+        return web.json_response({"picked_team": {
+            "score": team_id % 200,
+            "boosted_player_id": picks[0],
+            "mega_boosted_player_id": picks[1],
+            "picked_players": players,
+        }})
+
+    def _pick(self, player_id, position_id):
+        return {
+            "player": {
+                "id": player_id,
+                "position_id": position_id,
+                "external_id": f"{player_id:03d}DR{player_id:03d}",
+                "display_name": f"Player {player_id}",
+                "price": 10.0 + player_id / 2,
+                "current_price_change_info": {"current_selection_percentage": player_id * 1.5},
+            },
+            "score": player_id * 3,
+        }
+
+    async def events(self, request):
+        player_id = int(request.match_info["id"])
+        return web.json_response({"game_periods_scores": [
+            {"game_period_id": period, "events": [
+                {"display_name": "race position", "freq": 1, "points": (player_id + period) % 25},
+                {"display_name": "overtake bonus", "freq": period % 4, "points": period % 4},
+                {"display_name": "qualifying position", "freq": 1, "points": (player_id * period) % 10},
+            ]}
+            for period in range(1, GAME_PERIOD + 1)
+        ]})
+
+    async def next_race(self, request):
+        return web.json_response({
+            "division": request.query.get("division", "bench"), "round_number": 5, "name": "Bench GP",
+            "start_time": "2030-06-01T18:00:00Z",
+        })
+
+    async def info(self, request):
+        return web.json_response({"season": SEASON})
+
+    async def standings(self, request):
+        return web.json_response([
+            {"position": position, "name": name, "team": {"name": TEAMS[(position - 1) // 2]}, "points": 400 - position * 15}
+            for position, name in enumerate(DRIVERS, 1)
+        ])
+
+    async def schedule(self, request):
+        return web.json_response([
+            {"round_number": race, "name": f"Round {race} GP", "start_time": f"2021-{race % 12 + 1:02d}-15T18:00:00Z"}
+            for race in range(1, self.races + 1)
+        ])
+
+    def _results(self):
+        rows = []
+        for race in range(1, self.races + 1):
+            for index, driver in enumerate(DRIVERS):
+                position = (index + race) % len(DRIVERS) + 1
+                dnf = DNF_REASONS[race % len(DNF_REASONS)] if position > 17 else None
+                rows.append({
+                    "driver": driver, "qualifying_position": (index + race * 2) % len(DRIVERS) + 1,
+                    "race_position": position, "points": max(0, 11 - position), "dnf_reason": dnf,
+                    "qualifying_penalty_grid": int(position == 9), "race_penalty_time": int(position == 12) * 5,
+                    "penalty_points": int(position == 12), "laps_completed": 30 if dnf is None else 12,
+                    "laps_lead": 30 if position == 1 else 0, "fastest_lap": position == 2,
+                })
+        return rows
+
+    async def results(self, request):
+        return web.json_response(self._results())
+
+    async def stats(self, request):
+        query = request.query.get("driver", "").lower()
+        rows = [row for row in self._results() if query in row["driver"].lower()]
+        if not rows:
+            return web.json_response({"error": "Driver not found."})
+
+        finishes = [row["race_position"] for row in rows if not row["dnf_reason"]]
+        qualifying = [row["qualifying_position"] for row in rows]
+        return web.json_response({
+            "name": rows[0]["driver"], "attendance": len(rows),
+            "points_finishes": sum(1 for row in rows if row["points"]),
+            "qualifying_positions": qualifying, "avg_qualifying": sum(qualifying) / len(qualifying),
+            "pole_positions": qualifying.count(1), "race_positions": finishes,
+            "avg_race": sum(finishes) / len(finishes) if finishes else 0,
+            "best_finish": min(finishes) if finishes else 0, "wins": finishes.count(1),
+            "podiums": sum(1 for position in finishes if position <= 3),
+            "dnf_reasons": [row["dnf_reason"] for row in rows if row["dnf_reason"]],
+            "qualifying_penalty_dsq": 0, "qualifying_penalty_grid": 0, "qualifying_penalty_bog": 0,
+            "qualifying_penalty_sfp": 0, "race_penalty_dsq": 0, "race_penalty_time": 0,
+            "race_penalty_positions": 0, "penalty_points": 0,
+            "laps_completed": sum(row["laps_completed"] for row in rows),
+            "laps_lead": sum(row["laps_lead"] for row in rows),
+            "fastest_laps": sum(1 for row in rows if row["fastest_lap"]),
+        })
@@ -0,0 +1,40 @@
+class FakeMessage:
+    """Stands in for the progress message update_fantasy_details edits."""
+
+    def __init__(self, content=None):
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content=None):
+        self.content = content
+        self.edits += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name="Bench"):
+        self.id = guild_id
+        self.name = name
+        self.emojis = []
+        self.text_channels = []
+
+
+class FakeAuthor:
+    def __init__(self, author_id):
+        self.id = author_id
+
+
+class FakeContext:
+    """The parts of commands.Context the cogs use, recording everything sent."""
+
+    def __init__(self, bot, guild_id=1, author_id=1):
+        self.bot = bot
+        self.guild = FakeGuild(guild_id)
+        self.author = FakeAuthor(author_id)
+        self.sent = []
+
+    async def send(self, content=None):
+        self.sent.append(content)
+        return FakeMessage(content)
+
+    async def send_help(self, *args):
+        pass
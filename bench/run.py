@@ -0,0 +1,232 @@
+"""Offline benchmarks for the fantasy update pipeline and the bot commands.
+
+Everything runs against bench.fake_api in a temporary directory, so no credentials or network are needed:
+
+    python -m bench.run --sizes 20,200,2000 --latency 0.02 --error-rate 0.01 --throttle-rate 0.01
+
+The JSON report (bench-report.json by default) records wall time and request counts per update run and
+per-command latency, so runs can be compared to spot regressions.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_api import FakeAPI
+from bench.fakes import FakeContext, FakeMessage
+
+GUILD_ID = 1
+LEAGUE = {"tag": "BENCH", "f1_id": "1", "players": {}, "ignore": []}
+CREDENTIALS = {"fantasy": {"apikey": "bench", "username": "bench", "password": "bench"}}
+
+
+def bench_config(api, keep_rate_limits=False):
+    with open(os.path.join(ROOT, "config.json")) as infile:
+        config = json.load(infile)
+
+    config["urls"].update(api.urls())
+    limit = config.get("rate_limits", {}).get("fantasy-api.formula1.com")
+    config["rate_limits"] = {f"127.0.0.1:{api.port}": limit} if keep_rate_limits and limit else {}
+    config["fantasy"][str(GUILD_ID)] = dict(LEAGUE)
+    config["division_map"]["bench"] = "bench"
+    config["division_season"] = {}
+    config["season_info"] = {}
+    config["caches"] = {}
+    config["history_db"] = "fantasy.db"
+    return config
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(samples):
+    return {
+        "cold_ms": round(samples[0] * 1000, 3),
+        "p50_ms": round(percentile(samples[1:] or samples, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(samples[1:] or samples, 0.95) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+    }
+
+
+async def bench_update(api, config, size, churn):
+    from f1session import F1Session
+    from history import FantasyHistory
+    from utils import update_fantasy_details
+    from web import WebClient
+
+    client = WebClient(config.get("http"), config.get("rate_limits"))
+    session = F1Session(config, CREDENTIALS, client, path=f"cookie-{size}.txt")
+    history = FantasyHistory(f"update-{size}.db")
+    league = dict(LEAGUE, tag=f"BENCH{size}")
+    api.set_entrants(size)
+
+    runs = []
+    try:
+        for mode in ("full", "unchanged", "churn"):
+            if mode == "churn":
+                api.churn(churn)
+            api.reset_counters()
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ok = await update_fantasy_details(FakeMessage(), league, config, session, history, full=mode == "full")
+            elapsed = time.perf_counter() - start
+
+            runs.append({
+                "entrants": size,
+                "mode": mode,
+                "ok": ok,
+                "seconds": round(elapsed, 4),
+                "entrants_per_second": round(size / elapsed, 1),
+                "requests": sum(api.requests.values()),
+                "by_endpoint": dict(api.requests),
+                "statuses": {str(status): count for status, count in api.statuses.items()},
+            })
+    finally:
+        session.close()
+        history.close()
+        await client.close()
+
+    return runs
+
+
+async def bench_commands(api, iterations):
+    from discord.ext import commands
+    from cogs.f1fantasy import F1Fantasy
+    from cogs.rlmbot import RLMBot
+
+    bot = commands.Bot(command_prefix="+")
+    rlm = RLMBot(bot)
+    fantasy = F1Fantasy(bot)
+    fantasy.refresher.cancel()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        await fantasy._refresh_league(fantasy.league_index[str(GUILD_ID)], full=True)
+        await fantasy._prefetch_events()
+
+    cases = [
+        ("standings", rlm, rlm.standings, ("bench",)),
+        ("standings driver", rlm, rlm.standings, ("bench", "perez")),
+        ("schedule", rlm, rlm.schedule, ("bench",)),
+        ("stats", rlm, rlm.stats, ("hamilton",)),
+        ("stats season", rlm, rlm.stats, ("hamilton", "1", "bench")),
+        ("fantasy show", fantasy, fantasy.show, ()),
+        ("fantasy events all", fantasy, fantasy.events, ("all",)),
+    ]
+
+    results = {}
+    try:
+        for name, cog, command, args in cases:
+            api.reset_counters()
+            samples = []
+            for _ in range(iterations):
+                ctx = FakeContext(bot, GUILD_ID)
+                start = time.perf_counter()
+                await command.callback(cog, ctx, *args)
+                samples.append(time.perf_counter() - start)
+
+            results[name] = dict(summarize(samples), iterations=iterations, requests=sum(api.requests.values()))
+    finally:
+        rlm.cog_unload()
+        fantasy.cog_unload()
+        await asyncio.sleep(0)
+        await bot.close()
+
+    return results
+
+
+async def run(args):
+    api = FakeAPI(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=args.seed)
+    await api.start()
+    config = bench_config(api, args.keep_rate_limits)
+    with open("config.json", "w") as outfile:
+        json.dump(config, outfile, indent=4)
+    with open("credentials.json", "w") as outfile:
+        json.dump(CREDENTIALS, outfile)
+
+    report = {
+        "generated": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "update": [],
+        "commands": {},
+    }
+    try:
+        for size in args.sizes:
+            report["update"].extend(await bench_update(api, config, size, args.churn))
+
+        if args.iterations:
+            api.set_entrants(args.league_size)
+            report["commands"] = await bench_commands(api, args.iterations)
+    finally:
+        await api.stop()
+
+    return report
+
+
+def print_report(report):
+    from terminaltables import AsciiTable
+
+    data = [["Entrants", "Mode", "OK", "Seconds", "Entrants/s", "Requests"]]
+    for entry in report["update"]:
+        data.append([
+            entry["entrants"], entry["mode"], entry["ok"], entry["seconds"], entry["entrants_per_second"], entry["requests"]
+        ])
+    print(AsciiTable(data, "update_fantasy_details").table)
+
+    data = [["Command", "Cold ms", "p50 ms", "p95 ms", "Requests"]]
+    for name, entry in report["commands"].items():
+        data.append([name, entry["cold_ms"], entry["p50_ms"], entry["p95_ms"], entry["requests"]])
+    print(AsciiTable(data, "Commands").table)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a local fake API.")
+    parser.add_argument("--sizes", default="20,200,2000", type=lambda v: [int(s) for s in v.split(",")],
+                        help="comma separated league sizes to update")
+    parser.add_argument("--latency", default=0.0, type=float, help="seconds added to every fake API response")
+    parser.add_argument("--error-rate", default=0.0, type=float, help="share of entrant requests answered with a 500")
+    parser.add_argument("--throttle-rate", default=0.0, type=float, help="share of entrant requests answered with a 429")
+    parser.add_argument("--churn", default=0.1, type=float, help="share of entrants whose score changes before the churn run")
+    parser.add_argument("--iterations", default=20, type=int, help="calls per command, 0 to skip the command benchmarks")
+    parser.add_argument("--league-size", default=200, type=int, help="entrants in the league behind fantasy show")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="apply the configured fantasy API rate limit")
+    parser.add_argument("--seed", default=1, type=int)
+    parser.add_argument("--output", default="bench-report.json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+
+    # The bot writes its state files (and utils its log) relative to the working directory.
+    with tempfile.TemporaryDirectory(prefix="rlmbot-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            report = asyncio.get_event_loop().run_until_complete(run(args))
+        finally:
+            os.chdir(cwd)
+
+    with open(output, "w") as outfile:
+        json.dump(report, outfile, indent=4)
+
+    print_report(report)
+    print(f"Report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
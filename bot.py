@@ -1,7 +1,11 @@
 import discord
+import time
 from discord.ext import commands
 from cogs.rlmbot import RLMBot
 from cogs.f1fantasy import F1Fantasy
+from metrics import metrics
+from config_store import get_store
+from loop_watchdog import LoopWatchdog
 
 intents = discord.Intents.default()
 intents.members = True
@@ -17,6 +21,26 @@ async def on_ready():
     print(f"Logged in as {bot.user} ({bot.user.id})")
 
 
+@bot.event
+async def on_command(ctx):
+    ctx.started = time.perf_counter()
+
+
+@bot.event
+async def on_command_completion(ctx):
+    command = ctx.command.qualified_name
+    started = getattr(ctx, "started", None)
+    if started is not None:
+        metrics.observe("rlmbot_command_duration_seconds", time.perf_counter() - started, command=command)
+    metrics.inc("rlmbot_commands_total", command=command)
+
+
+settings = get_store(bot).data.get("watchdog", {})
+watchdog = LoopWatchdog(bot.loop, settings.get("interval", 0.25), settings.get("threshold", 1.0))
+bot.before_invoke(watchdog.command_started)
+bot.after_invoke(watchdog.command_finished)
+watchdog.start()
+
 bot.add_cog(RLMBot(bot))
 bot.add_cog(F1Fantasy(bot))
 bot.run("TOKEN", reconnect=True)
@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class DiskCache:
+    """JSON documents stored one file per key, evicting the least recently used beyond max_entries."""
+
+    def __init__(self, path, max_entries=5000, name=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.name = name or os.path.basename(path)
+
+        os.makedirs(path, exist_ok=True)
+        self.index = {
+            name[:-5]: os.stat(os.path.join(path, name)).st_mtime
+            for name in os.listdir(path)
+            if name.endswith(".json")
+        }
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key):
+        if key not in self.index:
+            metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="miss")
+            return None
+
+        try:
+            with open(self._file(key)) as infile:
+                value = json.load(infile)
+            os.utime(self._file(key))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.index.pop(key, None)
+            metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="miss")
+            return None
+
+        self.index[key] = time.time()
+        metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="hit")
+        return value
+
+    def set(self, key, value):
+        tmp = f"{self._file(key)}.tmp"
+        with open(tmp, "w") as outfile:
+            json.dump(value, outfile)
+        os.replace(tmp, self._file(key))
+
+        self.index[key] = time.time()
+        self._evict()
+
+    def _evict(self):
+        excess = len(self.index) - self.max_entries
+        if excess <= 0:
+            return
+
+        for key in heapq.nsmallest(excess, self.index, key=self.index.get):
+            del self.index[key]
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+
+class PeriodCache(DiskCache):
+    """DiskCache for data belonging to a fantasy game period, only complete once a later period is seen."""
+
+    def __init__(self, path, max_entries=5000, name=None):
+        super().__init__(path, max_entries, name)
+        self.live_period = None
+
+    def observe(self, period):
+        if period is not None and (self.live_period is None or period > self.live_period):
+            self.live_period = period
+
+    def is_final(self, period):
+        return period is not None and self.live_period is not None and period < self.live_period
+
+
+class JSONFileCache:
+    """Parsed JSON files kept in memory until they change on disk."""
+
+    def __init__(self, loader=None, name="json_files"):
+        self.loader = loader
+        self.name = name
+        self.entries = {}
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        entry = self.entries.get(path)
+        hit = entry is not None and entry[0] == mtime
+        metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="hit" if hit else "miss")
+        if not hit:
+            if self.loader is not None:
+                entry = (mtime, self.loader(path))
+            else:
+                with open(path) as infile:
+                    entry = (mtime, json.load(infile))
+            self.entries[path] = entry
+
+        return entry[1]
+
+    def version(self, path):
+        entry = self.entries.get(path)
+        return entry[0] if entry else None
+
+    def invalidate(self, path):
+        self.entries.pop(path, None)
+
+
+class RenderCache:
+    """Rendered command output keyed by command, scope and arguments, valid for one data version."""
+
+    def __init__(self, max_entries=256, name="render"):
+        self.max_entries = max_entries
+        self.name = name
+        self.entries = OrderedDict()
+
+    def get(self, command, scope, version, args=()):
+        key = (command, scope, args)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="miss")
+            return None
+
+        metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="hit")
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, command, scope, version, args, value):
+        key = (command, scope, args)
+        self.entries[key] = (version, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, command, scope):
+        for key in [k for k in self.entries if k[:2] == (command, scope)]:
+            del self.entries[key]
+
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers asking for the same key."""
+
+    def __init__(self):
+        self.calls = {}
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    async def do(self, key, fn):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key) if self.calls.get(key) is f else None)
+
+        return await asyncio.shield(future)
+
+
+class CacheEntry:
+    __slots__ = ("value", "fetched", "version", "size")
+
+    def __init__(self, value, version, size):
+        self.value = value
+        self.fetched = time.monotonic()
+        self.version = version
+        self.size = size
+
+
+class TTLCache:
+    """Async LRU cache that serves stale entries while refreshing them in the background."""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, weigh=lambda value: 1, cacheable=lambda value: True, name="ttl"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.weigh = weigh
+        self.cacheable = cacheable
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = 0
+        self.flights = SingleFlight()
+
+    async def get(self, key, fetch, ttl):
+        entry = self.entries.get(key)
+        if entry is None:
+            metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="miss")
+            return await self.flights.do(key, lambda: self._load(key, fetch))
+
+        self.entries.move_to_end(key)
+        stale = time.monotonic() - entry.fetched > ttl
+        metrics.inc("rlmbot_cache_requests_total", cache=self.name, result="stale" if stale else "hit")
+        if stale and key not in self.flights:
+            asyncio.ensure_future(self._refresh(key, fetch))
+
+        return entry
+
+    async def _load(self, key, fetch):
+        value = await fetch()
+        previous = self.entries.get(key)
+        if previous is not None and body(previous.value) == body(value):
+            # Unchanged responses keep their version so renders and indexes built from them are reused.
+            version = previous.version
+        else:
+            self.version += 1
+            version = self.version
+        entry = CacheEntry(value, version, self.weigh(value))
+        if self.cacheable(value):
+            self._store(key, entry)
+
+        return entry
+
+    async def _refresh(self, key, fetch):
+        try:
+            await self.flights.do(key, lambda: self._load(key, fetch))
+        except Exception:
+            logging.exception(f"Background refresh of {key} failed")
+
+    def _store(self, key, entry):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.size
+
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+
+def body(value):
+    return getattr(value, "content", value)
+
+
+def get_disk_cache(config, name, cls=DiskCache):
+    settings = config.get("caches", {}).get(name, {})
+    return cls(settings.get("path", os.path.join("cache", name)), settings.get("max_entries", 5000), name)
@@ -1,139 +1,337 @@
-from discord.ext import commands
-from cachecontrol import CacheControl
+from discord.ext import commands, tasks
+from datetime import datetime, timedelta
 from terminaltables import AsciiTable
 from utils import *
+from web import get_client
+from config_store import get_store
+from history import FantasyHistory
+from f1session import F1Session, LoginError
+from cache import JSONFileCache, PeriodCache, RenderCache, SingleFlight, get_disk_cache
+from metrics import metrics
 import json
 
 
 class F1Fantasy(commands.Cog):
     def __init__(self, bot_obj):
         self.bot = bot_obj
-        self.config = {}
+        self.store = get_store(self.bot)
+        self.config = self.store.data
         self.credentials = {}
 
-        self.load_config()
-
-        self.session = CacheControl(requests.session())
-
-    def load_config(self):
+        self.load_credentials()
+        self._build_indexes()
+
+        self.client = get_client(self.bot, self.config)
+        self.team_cache = get_disk_cache(self.config, "picked_teams", PeriodCache)
+        for key in self.team_cache.index:
+            self.team_cache.observe(int(key.split("-", 1)[0]))
+        self.events_cache = get_disk_cache(self.config, "driver_events", PeriodCache)
+        for key in self.events_cache.index:
+            self.events_cache.observe(int(key.rsplit("-", 1)[1]))
+        self.details_cache = JSONFileCache(load_details, name="fantasy_details")
+        self.render_cache = RenderCache(name="fantasy_render")
+        self.history_db = FantasyHistory(self.config.get("history_db", "fantasy.db"))
+
+        self.last_refresh = {}
+        self.refreshes = SingleFlight()
+        self.events_fetched = {}
+        self.event_fetches = SingleFlight()
+        self.last_events_prefetch = datetime.min
+        self.f1_session = None
+        if 'fantasy' in self.credentials:
+            self.f1_session = F1Session(self.config, self.credentials, self.client)
+            self.refresher.start()
+
+    def cog_unload(self):
+        self.refresher.cancel()
+        if self.f1_session is not None:
+            self.f1_session.close()
+        self.store.flush()
+        self.history_db.close()
+        self.bot.loop.create_task(self.client.close())
+
+    def load_credentials(self):
         try:
-            with open("config.json") as config:
-                self.config = json.load(config)
             with open("credentials.json") as credentials:
                 self.credentials = json.load(credentials)
         except FileNotFoundError:
-            self.config = {
-                "division_season": {},
-                "season_info": {},
-                "division_map": {},
-                "fantasy": {},
-            }
+            pass
 
     def save_config(self):
-        with open("config.json", "w") as config:
-            json.dump(self.config, config, indent=4)
-
-    def _find_league(self, ctx):
-        league = None
+        self.store.save()
 
-        try:
-            league = next(
-                iter(
-                    [
-                        info['tag']
-                        for league_id, info in self.config["fantasy"].items()
-                        if league_id == str(ctx.guild.id)
-                    ]
-                )
-            )
-        except StopIteration:
-            pass
+    def _build_indexes(self):
+        self.league_index = {
+            guild_id: info
+            for guild_id, info in self.config["fantasy"].items()
+            if isinstance(info, dict) and "tag" in info
+        }
+        self.player_index = {
+            guild_id: {info["id"]: f1_id for f1_id, info in league["players"].items()}
+            for guild_id, league in self.league_index.items()
+        }
+        self.driver_index = {
+            tag.lower(): f1_id
+            for f1_id, tag in self.config["fantasy"].get("drivers_teams", {}).items()
+        }
 
-        return league
+    def _leagues(self):
+        return list(self.league_index.values())
 
-    def _find_player(self, ctx):
-        player = None
+    async def _refresh_league(self, league, msg=None, full=False):
+        return await self.refreshes.do(league['tag'], lambda: self._update_league(league, msg, full))
 
+    async def _update_league(self, league, msg, full):
         try:
-            player = next(
-                iter(
-                    [
-                        f1_id
-                        for f1_id, info in self.config["fantasy"][str(ctx.guild.id)]["players"].items()
-                        if info["id"] == ctx.author.id
-                    ]
-                )
-            )
-        except StopIteration:
-            pass
+            await self.f1_session.get_cookie()
+        except LoginError:
+            metrics.inc("rlmbot_fantasy_refreshes_total", league=league['tag'], result="login_failed")
+            return "Fantasy update failed."
+
+        with metrics.timer("rlmbot_fantasy_refresh_duration_seconds", league=league['tag']):
+            updated = await update_fantasy_details(msg, league, self.config, self.f1_session, self.history_db, full=full, team_cache=self.team_cache)
+        metrics.inc("rlmbot_fantasy_refreshes_total", league=league['tag'], result="ok" if updated else "failed")
+        self.details_cache.invalidate(f"{league['tag']}-details.json")
+        self.render_cache.invalidate("show", league['tag'])
+        if not updated:
+            return "Fantasy update failed."
+
+        self.last_refresh[league['tag']] = datetime.utcnow()
+        return "Fantasy details updated."
+
+    async def _background_refresh(self, league, delay):
+        await asyncio.sleep(delay)
+        logging.info(f"Background refresh - {league['tag']}")
+        try:
+            logging.info(await self._refresh_league(league))
+        except Exception:
+            logging.exception(f"Background refresh of {league['tag']} failed")
+
+    @tasks.loop(minutes=1)
+    async def refresher(self):
+        settings = self.config.get('fantasy_refresh', {})
+        now = datetime.utcnow()
+        if now.weekday() in settings.get('race_days', [6, 0]):
+            interval = timedelta(minutes=settings.get('race_interval', 15))
+        else:
+            interval = timedelta(minutes=settings.get('idle_interval', 360))
+
+        due = [
+            league for league in self._leagues()
+            if league['tag'] not in self.refreshes
+            and now - self.last_refresh.get(league['tag'], datetime.min) >= interval
+        ]
+        for index, league in enumerate(due):
+            self.last_refresh[league['tag']] = now
+            self.bot.loop.create_task(self._background_refresh(league, index * settings.get('stagger', 60)))
+
+        if 'all' not in self.event_fetches and now - self.last_events_prefetch >= interval:
+            self.last_events_prefetch = now
+            self.bot.loop.create_task(self.event_fetches.do('all', self._prefetch_events))
+
+    @refresher.before_loop
+    async def before_refresher(self):
+        await self.bot.wait_until_ready()
+
+    async def _fetch_events(self, driver):
+        r = await self.f1_session.get(self.config['urls']['events_url'].format(driver))
+        if r.status_code not in [200, 304]:
+            logging.info(f"[events] HTTP status code - {r.status_code}")
+            return None
+
+        periods = [
+            (entry.get('game_period_id', index), entry['events'])
+            for index, entry in enumerate(loads(r.content)['game_periods_scores'], 1)
+        ]
+        for period, _ in periods:
+            self.events_cache.observe(period)
+
+        for period, events in periods:
+            key = f"{driver}-{period}"
+            if key not in self.events_cache.index or not self.events_cache.is_final(period):
+                self.events_cache.set(key, events)
+
+        self.events_fetched[driver] = time.monotonic()
+        self.render_cache.invalidate("events", "all")
+        return periods[-1][1] if periods else None
+
+    async def _driver_events(self, driver, max_age=None):
+        if max_age is None:
+            max_age = self.config.get('fantasy_events', {}).get('ttl', 900)
+
+        fetched = self.events_fetched.get(driver)
+        if fetched is not None and time.monotonic() - fetched < max_age:
+            events = self.events_cache.get(f"{driver}-{self.events_cache.live_period}")
+            if events is not None:
+                return events
+
+        return await self.event_fetches.do(driver, lambda: self._fetch_events(driver))
+
+    async def _prefetch_events(self):
+        semaphore = asyncio.Semaphore(self.config.get('fantasy_events', {}).get('concurrency', 8))
+
+        async def prefetch(driver):
+            async with semaphore:
+                try:
+                    await self._driver_events(driver, max_age=0)
+                except Exception:
+                    logging.exception(f"Events prefetch of {driver} failed")
 
-        return player
+        logging.info("Prefetching driver events")
+        await asyncio.gather(*[prefetch(driver) for driver in self.config['fantasy']['drivers_teams']])
 
-    def _find_driver(self, tag):
-        driver = None
+    def _find_league(self, ctx):
+        league = self.league_index.get(str(ctx.guild.id))
+        return league['tag'] if league else None
 
-        try:
-            driver = next(
-                iter(
-                    [
-                        f1_id
-                        for f1_id, info in self.config["fantasy"]["drivers_teams"].items()
-                        if info.lower() == tag.lower()
-                    ]
-                )
+    def _find_player(self, ctx):
+        return self.player_index.get(str(ctx.guild.id), {}).get(ctx.author.id)
+
+    def _find_driver(self, tag):
+        return self.driver_index.get(tag.lower())
+
+    def _player_details(self, league, player):
+        if self.history_db.version(league) is not None:
+            return self.history_db.player_details(league, player)
+
+        return self.details_cache.get(f"{league}-details.json").get(str(player))
+
+    def _render_fantasy(self, details):
+        headers = ["Pos", "Name", "Total", "Race", "Drivers", "Team", "Turbo", "Mega"]
+        data = []
+        pages = []
+        index = 1
+        for _, entry in details.items():
+            try:
+                drivers = ", ".join([e["short_name"] for e in entry["drivers"]])
+                team = entry["team"]["short_name"]
+            except (KeyError, TypeError):
+                drivers = ""
+                team = ""
+
+            data.append(
+                [
+                    p.ordinal(index),
+                    f"{entry['name']} *" if entry.get("stale") else entry["name"],
+                    format_float(entry["score"]),
+                    format_float(entry["race_score"]),
+                    drivers,
+                    team,
+                    entry["turbo"] or "???",
+                    entry["mega"] or "???"
+                ]
             )
-        except StopIteration:
-            pass
 
-        return driver
+            index += 1
+
+        for group in grouper(data, 10):
+            table_data = [headers]
+            for row in list(group):
+                if row is not None:
+                    table_data.append(row)
+
+            table_instance = AsciiTable(table_data)
+            table_instance.inner_column_border = False
+            table_instance.outer_border = False
+            table_instance.justify_columns[2] = "center"
+            table_instance.justify_columns[3] = "center"
+            table_instance.justify_columns[6] = "center"
+
+            pages.append("```{}```".format(table_instance.table))
+
+        return pages
+
+    def _render_events(self, events):
+        headers = ["Event", "Freq", "Points"]
+        data = [headers]
+
+        for event in events:
+            data.append([
+                fix_title_weirdness(event['display_name'].title()),
+                event['freq'],
+                format_float(event['points'])
+            ])
+
+        table_instance = AsciiTable(data)
+        table_instance.inner_column_border = False
+        table_instance.outer_border = False
+        table_instance.justify_columns[1] = "center"
+        table_instance.justify_columns[2] = "center"
+
+        return "```{}```".format(table_instance.table)
+
+    def _render_events_comparison(self, period):
+        headers = ["Driver", "Points", "Best", "Worst"]
+        data = []
+        pages = []
+        for driver, tag in self.config['fantasy']['drivers_teams'].items():
+            events = self.events_cache.get(f"{driver}-{period}")
+            if not events:
+                continue
+
+            ranked = sorted(events, key=lambda e: e['points'])
+            data.append([
+                tag,
+                sum(e['points'] for e in events),
+                f"{fix_title_weirdness(ranked[-1]['display_name'].title())} ({format_float(ranked[-1]['points'])})",
+                f"{fix_title_weirdness(ranked[0]['display_name'].title())} ({format_float(ranked[0]['points'])})"
+            ])
+
+        data.sort(key=lambda row: row[1], reverse=True)
+        for row in data:
+            row[1] = format_float(row[1])
+
+        for group in grouper(data, 10):
+            table_data = [headers]
+            for row in list(group):
+                if row is not None:
+                    table_data.append(row)
+
+            table_instance = AsciiTable(table_data)
+            table_instance.inner_column_border = False
+            table_instance.outer_border = False
+            table_instance.justify_columns[1] = "center"
+
+            pages.append("```{}```".format(table_instance.table))
+
+        return pages
+
+    async def _show_events_comparison(self, ctx):
+        period = self.events_cache.live_period
+        pages = self.render_cache.get("events", "all", period)
+        if pages is None:
+            pages = self._render_events_comparison(period)
+            if pages:
+                self.render_cache.set("events", "all", period, (), pages)
+
+        if not pages:
+            if 'all' not in self.event_fetches:
+                self.bot.loop.create_task(self.event_fetches.do('all', self._prefetch_events))
+            await ctx.send("Driver events are not cached yet, try again shortly.")
+            return
+
+        for content in pages:
+            await ctx.send(content)
 
     async def _show_fantasy(self, ctx):
         league = self._find_league(ctx)
 
         if league:
-            with open(f"{league}-details.json") as infile:
-                league = json.load(infile)
-
-            headers = ["Pos", "Name", "Total", "Race", "Drivers", "Team", "Turbo", "Mega"]
-            data = []
-            index = 1
-            for _, entry in league.items():
-                try:
-                    drivers = ", ".join([e["short_name"] for e in entry["drivers"]])
-                    team = entry["team"]["short_name"]
-                except KeyError:
-                    drivers = ""
-                    team = ""
-
-                data.append(
-                    [
-                        p.ordinal(index),
-                        entry["name"],
-                        format_float(entry["score"]),
-                        format_float(entry["race_score"]),
-                        drivers,
-                        team,
-                        entry["turbo"] or "???",
-                        entry["mega"] or "???"
-                    ]
-                )
-
-                index += 1
-
-            for group in grouper(data, 10):
-                table_data = [headers]
-                for row in list(group):
-                    if row is not None:
-                        table_data.append(row)
-
-                table_instance = AsciiTable(table_data)
-                table_instance.inner_column_border = False
-                table_instance.outer_border = False
-                table_instance.justify_columns[2] = "center"
-                table_instance.justify_columns[3] = "center"
-                table_instance.justify_columns[6] = "center"
-
-                content = "```{}```".format(table_instance.table)
+            details = None
+            version = self.history_db.version(league)
+            if version is None:
+                path = f"{league}-details.json"
+                details = self.details_cache.get(path)
+                version = f"file-{self.details_cache.version(path)}"
+
+            pages = self.render_cache.get("show", league, version)
+            if pages is None:
+                if details is None:
+                    details = self.history_db.league_details(league)
+                pages = self._render_fantasy(details)
+                self.render_cache.set("show", league, version, (), pages)
+
+            for content in pages:
                 await ctx.send(content)
         else:
             await ctx.send(f"League {league} not found.")
@@ -155,11 +353,11 @@ class F1Fantasy(commands.Cog):
         league = self._find_league(ctx)
 
         if league:
-            with open(f"{league}-details.json") as infile:
-                details = json.load(infile)
-
             player = self._find_player(ctx)
-            if player:
+            player_details = self._player_details(league, player) if player else None
+            if player and (player_details is None or player_details["team"] is None):
+                msg = "No details available for you yet, try again after the next update."
+            elif player:
                 totals = {
                     "points": 0,
                     "price": 0,
@@ -168,7 +366,6 @@ class F1Fantasy(commands.Cog):
 
                 headers = ["Name", "Turbo", "Mega", "Points", "Price", "Picked %"]
                 data = [headers]
-                player_details = details[str(player)]
                 for entry in player_details["drivers"]:
                     data.append(
                         [
@@ -232,6 +429,44 @@ class F1Fantasy(commands.Cog):
 
         await ctx.send(msg)
 
+    @fantasy.group()
+    async def history(self, ctx, count: int = 5):
+        """Show your points from the last few races."""
+        league = self._find_league(ctx)
+        player = self._find_player(ctx) if league else None
+
+        if not league:
+            msg = f"League {league} not found."
+        elif not player:
+            msg = "Player not found."
+        else:
+            rows = self.history_db.player_history(league, player, max(1, min(count, 25)))
+            if not rows:
+                msg = "No history available for you yet, try again after the next update."
+            else:
+                data = [["Race", "Pos", "Points", "Total", "Turbo", "Mega"]]
+                for row in rows:
+                    data.append(
+                        [
+                            row["period"],
+                            p.ordinal(row["position"]),
+                            format_float(row["race_score"]),
+                            format_float(row["score"]),
+                            row["turbo"] or "???",
+                            row["mega"] or "???"
+                        ]
+                    )
+
+                table_instance = AsciiTable(data)
+                table_instance.inner_column_border = False
+                table_instance.outer_border = False
+                table_instance.justify_columns[2] = "right"
+                table_instance.justify_columns[3] = "right"
+
+                msg = "```{}```".format(table_instance.table)
+
+        await ctx.send(msg)
+
     @fantasy.group(hidden=True)
     @commands.is_owner()
     async def set(self, ctx, league_id, tag):
@@ -240,6 +475,8 @@ class F1Fantasy(commands.Cog):
             "f1_id": league_id,
             "players": {}
         }
+        self.league_index[str(ctx.guild.id)] = self.config['fantasy'][str(ctx.guild.id)]
+        self.player_index[str(ctx.guild.id)] = {}
 
         self.save_config()
 
@@ -251,13 +488,16 @@ class F1Fantasy(commands.Cog):
         """Add player info."""
         msg = "Player not found."
         players = self.config['fantasy'][str(ctx.guild.id)]['players']
+        index = self.player_index.setdefault(str(ctx.guild.id), {})
         for member in ctx.guild.members:
             if player.lower() in member.name.lower():
                 found = False
-                for _, info in players.items():
+                for player_id, info in players.items():
                     if info['name'].lower() == alias.lower():
+                        index.pop(info['id'], None)
                         info['name'] = alias
                         info['id'] = member.id
+                        index[member.id] = player_id
                         found = True
                         msg = 'Updated'
                 if not found:
@@ -265,6 +505,7 @@ class F1Fantasy(commands.Cog):
                         "name": alias,
                         "id": member.id
                     }
+                    index[member.id] = f1_id
 
                     msg = 'added'
 
@@ -273,68 +514,42 @@ class F1Fantasy(commands.Cog):
         await ctx.send(f'{alias} {msg}.')
 
     @fantasy.group()
-    async def update(self, ctx):
-        """Update the fantasy details (points, position, etc)"""
+    async def update(self, ctx, option: str = None):
+        """Update the fantasy details (points, position, etc), use --full to refetch every player"""
         await ctx.send("This command takes a couple of minutes to complete, please be patient.")
         if 'fantasy' not in self.credentials:
             msg = "Credentials missing."
+        elif str(ctx.guild.id) not in self.config['fantasy']:
+            msg = "This server was not found in fantasy settings."
         else:
-            f1_cookie = generate_f1_cookie(self.config, self.credentials)
-            if not f1_cookie:
-                msg = "Fantasy update failed."
-            elif str(ctx.guild.id) not in self.config['fantasy']:
-                msg = "This server was not found in fantasy settings."
-            else:
-                league = self.config['fantasy'][str(ctx.guild.id)]
-                msg = await ctx.send(f"Updating {league['tag']}:")
-                await update_fantasy_details(msg, league, self.config, f1_cookie)
-                msg = "Fantasy details updated."
+            league = self.config['fantasy'][str(ctx.guild.id)]
+            msg = await ctx.send(f"Updating {league['tag']}:")
+            msg = await self._refresh_league(league, msg, full=option == "--full")
 
         await ctx.send(msg)
         await self._show_fantasy(ctx)
 
     @fantasy.group()
     async def events(self, ctx, tag):
-        """Show the point scoring events for a driver (most recent race)"""
-        await ctx.send("Fetching events, please wait")
-
+        """Show the point scoring events for a driver (most recent race), or 'all' to compare every driver"""
         if 'fantasy' not in self.credentials:
             msg = "Credentials missing."
+        elif str(ctx.guild.id) not in self.config['fantasy']:
+            msg = "This server was not found in fantasy settings."
+        elif tag.lower() == "all":
+            await self._show_events_comparison(ctx)
+            return
         else:
-            f1_cookie = generate_f1_cookie(self.config, self.credentials)
-            if not f1_cookie:
-                msg = "Events fetch failed."
-            elif str(ctx.guild.id) not in self.config['fantasy']:
-                msg = "This server was not found in fantasy settings."
+            driver = self._find_driver(tag)
+            if not driver:
+                msg = f"Driver {tag} not found"
             else:
-                driver = self._find_driver(tag)
-                if not driver:
-                    msg = f"Driver {tag} not found"
-                else:
-                    headers = {
-                        'X-F1-COOKIE-DATA': f1_cookie
-                    }
+                await ctx.send("Fetching events, please wait")
+                try:
+                    events = await self._driver_events(driver)
+                except LoginError:
+                    events = None
 
-                    r = requests.get(self.config['urls']['events_url'].format(driver), headers=headers)
-                    if r.status_code in [200, 304]:
-                        headers = ["Event", "Freq", "Points"]
-                        data = [headers]
-
-                        content = json.loads(r.content.decode('utf-8'))
-                        events = content['game_periods_scores'][-1]
-                        for event in events['events']:
-                            data.append([
-                                fix_title_weirdness(event['display_name'].title()),
-                                event['freq'],
-                                format_float(event['points'])
-                            ])
-
-                        table_instance = AsciiTable(data)
-                        table_instance.inner_column_border = False
-                        table_instance.outer_border = False
-                        table_instance.justify_columns[1] = "center"
-                        table_instance.justify_columns[2] = "center"
-
-                        msg = "```{}```".format(table_instance.table)
+                msg = "Events fetch failed." if events is None else self._render_events(events)
 
         await ctx.send(msg)
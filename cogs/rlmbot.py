@@ -1,40 +1,241 @@
-from discord.ext import commands
-from cachecontrol import CacheControl
+from discord.ext import commands, tasks
 from collections import Counter
 from terminaltables import AsciiTable
 from utils import *
+from web import get_client
+from cache import RenderCache, TTLCache
+from config_store import get_store
+from metrics import metrics
+from indexes import get_channel_index, get_emoji_index
+from search import NameIndex
+from stats import StatsEngine
 from dateutil.parser import *
 from dateutil.utils import today
 from dateutil.tz import *
 from dateutil.relativedelta import *
 import json
+import time
 
 
 class RLMBot(commands.Cog):
     def __init__(self, bot_obj):
         self.bot = bot_obj
-        self.config = {}
-        self.credentials = {}
-
-        self.load_config()
-
-        self.session = CacheControl(requests.session())
-
-    def load_config(self):
-        try:
-            with open("config.json") as config:
-                self.config = json.load(config)
-        except FileNotFoundError:
-            self.config = {
-                "division_season": {},
-                "season_info": {},
-                "division_map": {},
-                "fantasy": {},
-            }
+        self.store = get_store(self.bot)
+        self.config = self.store.data
+
+        self.client = get_client(self.bot, self.config)
+        self.render_cache = RenderCache(name="rlmbot_render")
+        self.api_cache = TTLCache(
+            self.config.get("api_cache", {}).get("max_bytes", 8 * 1024 * 1024),
+            weigh=lambda r: len(r.content),
+            cacheable=lambda r: r.status_code == 200,
+            name="api"
+        )
+        self.name_indexes = {}
+        self.stats_engine = StatsEngine()
+        self.results_failed = {}
+        self.emoji_index = get_emoji_index(self.bot)
+        self.channel_index = get_channel_index(self.bot)
+
+        settings = self.config.get("metrics", {})
+        if settings.get("path"):
+            self.metrics_writer.change_interval(seconds=settings.get("interval", 60))
+            self.metrics_writer.start()
+
+    def cog_unload(self):
+        self.metrics_writer.cancel()
+        self.store.flush()
+        self.bot.loop.create_task(self.client.close())
 
     def save_config(self):
-        with open("config.json", "w") as config:
-            json.dump(self.config, config, indent=4)
+        self.store.save()
+
+    @tasks.loop(seconds=60)
+    async def metrics_writer(self):
+        path = self.config["metrics"]["path"]
+        await self.bot.loop.run_in_executor(None, metrics.write, path)
+
+    @metrics_writer.after_loop
+    async def after_metrics_writer(self):
+        metrics.write(self.config["metrics"]["path"])
+
+    def _render_metrics(self):
+        data = [["Command", "Count", "Avg ms", "p95 ms"]]
+        for labels, histogram in sorted(metrics.series("histogram", "rlmbot_command_duration_seconds"), key=lambda s: s[0]["command"]):
+            data.append([
+                labels["command"],
+                histogram.count,
+                format_float(histogram.sum / histogram.count * 1000),
+                f"<{format_float(histogram.quantile(0.95) * 1000)}"
+            ])
+        tables = [data]
+
+        data = [["Host", "Requests", "Errors", "Avg ms"]]
+        statuses = metrics.series("counter", "rlmbot_http_requests_total")
+        for labels, histogram in sorted(metrics.series("histogram", "rlmbot_http_request_duration_seconds"), key=lambda s: s[0]["host"]):
+            errors = sum(
+                count for status_labels, count in statuses
+                if status_labels["host"] == labels["host"] and not str(status_labels["status"]).startswith("2")
+            )
+            data.append([labels["host"], histogram.count, errors, format_float(histogram.sum / histogram.count * 1000)])
+        tables.append(data)
+
+        data = [["Cache", "Hits", "Stale", "Misses", "Hit rate"]]
+        caches = {}
+        for labels, count in metrics.series("counter", "rlmbot_cache_requests_total"):
+            caches.setdefault(labels["cache"], Counter())[labels["result"]] += count
+        for name, results in sorted(caches.items()):
+            total = sum(results.values())
+            hit_rate = (results["hit"] + results["stale"]) / total * 100 if total else 0
+            data.append([name, results["hit"], results["stale"], results["miss"], f"{hit_rate:.1f}%"])
+        tables.append(data)
+
+        data = [["League", "Refreshes", "Avg s", "Entrants/s"]]
+        throughput = {labels["league"]: value for labels, value in metrics.series("gauge", "rlmbot_fantasy_entrants_per_second")}
+        for labels, histogram in sorted(metrics.series("histogram", "rlmbot_fantasy_refresh_duration_seconds"), key=lambda s: s[0]["league"]):
+            data.append([
+                labels["league"],
+                histogram.count,
+                format_float(histogram.sum / histogram.count),
+                format_float(throughput.get(labels["league"], 0))
+            ])
+        tables.append(data)
+
+        data = [["Stalled in", "Stalls"]]
+        for labels, count in sorted(metrics.series("counter", "rlmbot_loop_stalls_total"), key=lambda s: -s[1]):
+            data.append([labels["command"], count])
+        tables.append(data)
+
+        pages = []
+        for data in tables:
+            if len(data) == 1:
+                continue
+
+            table_instance = AsciiTable(data)
+            table_instance.inner_column_border = False
+            table_instance.outer_border = False
+            pages.append("```{}```".format(table_instance.table))
+
+        return pages
+
+    @commands.command(name="metrics", hidden=True)
+    @commands.is_owner()
+    async def show_metrics(self, ctx):
+        """Show command latency, HTTP, cache and fantasy refresh metrics."""
+        pages = self._render_metrics()
+        if not pages:
+            await ctx.send("No metrics recorded yet.")
+
+        for content in pages:
+            await ctx.send(content)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.emoji_index.rebuild(self.bot.guilds)
+        self.channel_index.rebuild(self.bot.guilds)
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        self.emoji_index.update_guild(guild, after)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.emoji_index.update_guild(guild, guild.emojis)
+        self.channel_index.add_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.emoji_index.remove_guild(guild)
+        self.channel_index.remove_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before, after):
+        self.channel_index.add_guild(after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        self.channel_index.index_guild(channel.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.channel_index.index_guild(channel.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        self.channel_index.index_guild(after.guild)
+
+    def _ttl(self, endpoint):
+        return self.config.get("api_cache", {}).get("ttl", {}).get(endpoint, 60)
+
+    async def _api_get(self, endpoint, url):
+        return await self.api_cache.get(url, lambda: self.client.get(url), self._ttl(endpoint))
+
+    async def _standings(self, season_id):
+        return await self._api_get("standings", f"{self.config['urls']['base_url']}/api/standings/{season_id}")
+
+    def _driver_index(self, season_id, entry):
+        cached = self.name_indexes.get(season_id)
+        if cached is None or cached[0] != entry.version:
+            try:
+                names = [d["name"] for d in json.loads(entry.value.content)]
+            except (json.decoder.JSONDecodeError, KeyError, TypeError):
+                names = []
+            cached = (entry.version, NameIndex(names))
+            self.name_indexes[season_id] = cached
+
+        return cached[1]
+
+    async def _resolve_driver(self, driver, season, division=None):
+        # Misspellings are only corrected against the standings of the season being asked about; across
+        # seasons only exact and prefix hits are trusted, and without a division the server matches the name.
+        if season:
+            seasons = self._find_seasons(season, division)
+            min_score = 0
+        elif division and await get_current_season(division, self):
+            seasons = [self.config["division_season"][division]]
+            min_score = 2
+        else:
+            return None
+
+        best = None
+        for season_id in seasons:
+            index = self._driver_index(season_id, await self._standings(season_id))
+            result = index.match(driver)
+            if result is not None and result[0] >= min_score and (best is None or result[0] > best[0]):
+                best = (result[0], index.names[result[1]])
+
+        return best[1] if best else None
+
+    def _find_seasons(self, season, division=None):
+        season = season.lower()
+        matches = [
+            season_id for season_id, info in self.config["season_info"].items()
+            if season_id == season or str(info.get("name", "")).lower() == season
+        ]
+        if division and self.config["division_season"].get(division) in matches:
+            return [self.config["division_season"][division]]
+
+        return matches if len(matches) == 1 else []
+
+    async def _local_stats(self, driver, season, division=None):
+        tables = []
+        for season_id in self._find_seasons(season, division):
+            # The API cache only keeps 200s, so a failed season is remembered here to retry it once per TTL.
+            failed = self.results_failed.get(season_id)
+            if failed is not None and time.monotonic() - failed < self._ttl("results"):
+                return None
+
+            entry = await self._api_get("results", f"{self.config['urls']['base_url']}/api/results?season={season_id}")
+            try:
+                if entry.value.status_code != 200:
+                    raise ValueError(f"HTTP status code {entry.value.status_code}")
+                tables.append(self.stats_engine.table(season_id, entry.version, entry.value.json))
+            except (ValueError, AttributeError, TypeError) as e:
+                logging.info(f"No local results for season {season_id} - {e!r}")
+                self.results_failed[season_id] = time.monotonic()
+                return None
+
+        return self.stats_engine.stats(driver, tables) if tables else None
 
     @commands.command()
     async def nextrace(self, ctx, division: str = None):
@@ -43,7 +244,7 @@ class RLMBot(commands.Cog):
         if division:
             url += f"?division={division}"
 
-        r = self.session.get(url)
+        r = (await self._api_get("next-race", url)).value
         next_race = json.loads(r.content)
 
         now = datetime.today().utcnow().replace(second=0, microsecond=0)
@@ -62,21 +263,27 @@ class RLMBot(commands.Cog):
     @commands.command()
     async def stats(self, ctx, driver: str, season: str = None, division: str = None):
         """Show stats for a particular driver, optionally filtered by season and division"""
-        if len(driver) < 3:
+        if division:
+            division = self.config["division_map"].get(
+                division.lower(), division.lower()
+            )
+
+        stats = await self._local_stats(driver, season, division) if season else None
+        if stats is None:
+            driver = await self._resolve_driver(driver, season, division) or driver
+            if len(driver) >= 3:
+                url = f"{self.config['urls']['base_url']}/api/stats?driver={driver.lower()}"
+                if season:
+                    url += f"&season={season.lower()}"
+                if division:
+                    url += f"&division={division.lower()}"
+
+                r = (await self._api_get("stats", url)).value
+                stats = json.loads(r.content)
+
+        if stats is None:
             msg = "Minimum search length is 3 characters"
         else:
-            url = f"{self.config['urls']['base_url']}/api/stats?driver={driver.lower()}"
-            if season:
-                url += f"&season={season.lower()}"
-            if division:
-                division = self.config["division_map"].get(
-                    division.lower(), division.lower()
-                )
-                url += f"&division={division.lower()}"
-
-            r = self.session.get(url)
-            stats = json.loads(r.content)
-
             if "name" not in stats:
                 if "error" in stats:
                     msg = stats["error"]
@@ -120,23 +327,9 @@ class RLMBot(commands.Cog):
 
         await ctx.send(msg)
 
-    @commands.command()
-    async def standings(self, ctx, division, driver: str = None):
-        """Show standings for the current season of the specified division."""
-        division = self.config["division_map"].get(division.lower(), division.lower())
-        if not get_current_season(division, self):
-            await ctx.send("No seasons found for division")
-
-        season_id = self.config["division_season"][division.lower()]
-        teams_disabled = self.config["season_info"][season_id]["teams_disabled"]
-
-        url = f"{self.config['urls']['base_url']}/api/standings/{season_id}"
-        if driver:
-            url += f"?driver={driver.lower()}"
-
-        r = self.session.get(url)
+    def _render_standings(self, content, season_id, teams_disabled, found):
         try:
-            standings = json.loads(r.content)
+            standings = json.loads(content)
 
             data = [["Pos", "Driver", "Team", "Points"]]
 
@@ -146,40 +339,19 @@ class RLMBot(commands.Cog):
             for pos in standings[0:5]:
                 add_row(data, pos, teams_disabled)
 
-            found = False
-            if driver:
+            if found is not None and found >= 5:
+                prev_pos = standings[found - 1]
+                if prev_pos["position"] > 6:
+                    data.append(["..."])
+                if prev_pos["position"] > 5:
+                    add_row(data, prev_pos, teams_disabled)
+                add_row(data, standings[found], teams_disabled)
                 try:
-                    found = next(
-                        iter([d for d in data if driver.lower() in d[1].lower()])
-                    )
-                except StopIteration:
+                    next_pos = standings[found + 1]
+                    add_row(data, next_pos, teams_disabled)
+                except IndexError:
                     pass
 
-                if not found:
-                    try:
-                        info = next(
-                            iter(
-                                [
-                                    {"index": i, "details": d}
-                                    for i, d in enumerate(standings)
-                                    if driver.lower() in d["name"].lower()
-                                ]
-                            )
-                        )
-                        prev_pos = standings[info["index"] - 1]
-                        if prev_pos["position"] > 6:
-                            data.append(["..."])
-                        if prev_pos["position"] > 5:
-                            add_row(data, prev_pos, teams_disabled)
-                        add_row(data, info["details"], teams_disabled)
-                        try:
-                            next_pos = standings[info["index"] + 1]
-                            add_row(data, next_pos, teams_disabled)
-                        except IndexError:
-                            pass
-                    except StopIteration:
-                        pass
-
             table_instance = AsciiTable(data)
             table_instance.inner_column_border = False
             table_instance.outer_border = False
@@ -192,25 +364,34 @@ class RLMBot(commands.Cog):
             season = "Error"
             msg = "There was an error retrieving the standings"
 
-        await ctx.send(f"```{season}\n\n{msg}```")
+        return f"```{season}\n\n{msg}```"
 
     @commands.command()
-    async def schedule(self, ctx, division):
-        """Show the schedule for the current season of the specified division."""
+    async def standings(self, ctx, division, driver: str = None):
+        """Show standings for the current season of the specified division."""
         division = self.config["division_map"].get(division.lower(), division.lower())
-        if not get_current_season(division, self):
+        if not await get_current_season(division, self):
             await ctx.send("No seasons found for division")
 
         season_id = self.config["division_season"][division.lower()]
+        teams_disabled = self.config["season_info"][season_id]["teams_disabled"]
 
-        url = f"{self.config['urls']['base_url']}/api/races?season={season_id}"
-        r = self.session.get(url)
+        entry = await self._standings(season_id)
+        index = self._driver_index(season_id, entry)
+        found = index.find(driver) if driver else None
+        msg = self.render_cache.get("standings", season_id, entry.version, found)
+        if msg is None:
+            msg = self._render_standings(entry.value.content, season_id, teams_disabled, found)
+            self.render_cache.set("standings", season_id, entry.version, found, msg)
+
+        await ctx.send(msg)
+
+    def _render_schedule(self, content, season_id, this_day):
         try:
-            schedule = json.loads(r.content)
+            schedule = json.loads(content)
 
             data = [["Round", "Name", "Start Time"]]
 
-            this_day = today(tzinfo=tzutc())
             for event in schedule:
                 start_time = parse(event["start_time"]).replace(
                     hour=0, minute=0, second=0, microsecond=0
@@ -236,16 +417,67 @@ class RLMBot(commands.Cog):
             season = "Error"
             msg = "There was an error retrieving the schedule"
 
-        await ctx.send(f"```{season}\n\n{msg}```")
+        return f"```{season}\n\n{msg}```"
+
+    @commands.command()
+    async def schedule(self, ctx, division):
+        """Show the schedule for the current season of the specified division."""
+        division = self.config["division_map"].get(division.lower(), division.lower())
+        if not await get_current_season(division, self):
+            await ctx.send("No seasons found for division")
+
+        season_id = self.config["division_season"][division.lower()]
+
+        url = f"{self.config['urls']['base_url']}/api/races?season={season_id}"
+        entry = await self._api_get("races", url)
+        this_day = today(tzinfo=tzutc())
+        key = this_day.date()
+        msg = self.render_cache.get("schedule", season_id, entry.version, key)
+        if msg is None:
+            msg = self._render_schedule(entry.value.content, season_id, this_day)
+            self.render_cache.set("schedule", season_id, entry.version, key, msg)
+
+        await ctx.send(msg)
 
     @commands.command(hidden=True)
     async def parrot(self, ctx, guild, channel, msg):
-        try:
-            guild_obj = next(iter([x for x in ctx.bot.guilds if x.name == guild]))
-            if guild_obj:
-                channel_obj = next(iter([x for x in guild_obj.channels if x.name == channel]))
-                if channel_obj:
-                    msg = find_emojis(msg, ctx.bot)
-                    await channel_obj.send(msg)
-        except StopIteration:
+        channel_obj = self.channel_index.find(guild, channel)
+        if channel_obj is None:
             await ctx.send(f"Guild '{guild}' or channel '{channel}' not found")
+        else:
+            await channel_obj.send(find_emojis(msg, ctx.bot))
+
+    @commands.command(name="parrot-many", hidden=True)
+    async def parrot_many(self, ctx, msg, *targets):
+        """Send a message to several channels, each given as guild/channel."""
+        channels = {}
+        missing = []
+        for target in targets:
+            guild, _, channel = target.rpartition("/")
+            channel_obj = self.channel_index.find(guild, channel)
+            if channel_obj is None:
+                missing.append(target)
+            else:
+                channels[target] = channel_obj
+
+        msg = find_emojis(msg, ctx.bot)
+        semaphore = asyncio.Semaphore(self.config.get("parrot", {}).get("concurrency", 5))
+
+        async def send(channel_obj):
+            async with semaphore:
+                await channel_obj.send(msg)
+
+        results = await asyncio.gather(*[send(c) for c in channels.values()], return_exceptions=True)
+        failed = []
+        for target, result in zip(channels, results):
+            if isinstance(result, Exception):
+                logging.info(f"Parrot to {target} failed - {result}")
+                failed.append(target)
+
+        reply = f"Sent to {len(channels) - len(failed)}/{len(targets)} channels."
+        if missing:
+            reply += f" Not found: {', '.join(missing)}."
+        if failed:
+            reply += f" Failed: {', '.join(failed)}."
+
+        await ctx.send(reply)
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+import threading
+
+
+class ConfigStore:
+    """config.json shared by every cog, written back in debounced batches."""
+
+    def __init__(self, path="config.json", delay=2):
+        self.path = path
+        self.delay = delay
+        self.dirty = False
+        self.handle = None
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.written = 0
+
+        try:
+            with open(path) as config:
+                self.data = json.load(config)
+        except FileNotFoundError:
+            self.data = {
+                "division_season": {},
+                "season_info": {},
+                "division_map": {},
+                "fantasy": {},
+            }
+
+    def save(self):
+        self.dirty = True
+        self.generation += 1
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(self.delay, self._flush_later)
+
+    def _flush_later(self):
+        self.handle = None
+        if self.dirty:
+            self.dirty = False
+            content = json.dumps(self.data, indent=4)
+            asyncio.get_event_loop().run_in_executor(None, self._write, content, self.generation)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.dirty:
+            self.dirty = False
+            self._write(json.dumps(self.data, indent=4), self.generation)
+
+    def _write(self, content, generation):
+        with self.lock:
+            if generation <= self.written:
+                return
+
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as config:
+                config.write(content)
+            os.replace(tmp, self.path)
+            self.written = generation
+
+
+def get_store(bot):
+    if getattr(bot, "config_store", None) is None:
+        bot.config_store = ConfigStore()
+
+    return bot.config_store
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from base64 import b64decode, b64encode, urlsafe_b64decode
+from urllib import parse
+
+
+class LoginError(Exception):
+    pass
+
+
+def token_expiry(token):
+    """Expiry time of a JWT subscription token, or None when it can't be read."""
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class F1Session:
+    """F1 fantasy login kept in memory, renewed before it lapses and once more on a 401."""
+
+    def __init__(self, config, credentials, client, path="cookie.txt"):
+        self.config = config
+        self.credentials = credentials
+        self.client = client
+        self.path = path
+
+        settings = config.get('f1_session', {})
+        self.lifetime = settings.get('lifetime', 86400)
+        self.refresh_margin = settings.get('refresh_margin', 600)
+
+        self.cookie = None
+        self.expires = 0
+        self.lock = asyncio.Lock()
+        self.refresh_task = None
+
+        self._load_stored()
+
+    def _load_stored(self):
+        try:
+            with open(self.path) as infile:
+                cookie = infile.read().strip()
+            stored = os.stat(self.path).st_mtime
+            info = json.loads(parse.unquote(b64decode(cookie).decode('utf8')))
+            token = info['data']['subscriptionToken']
+        except (FileNotFoundError, KeyError, TypeError, ValueError):
+            return
+
+        self.cookie = cookie
+        self.expires = token_expiry(token) or stored + self.lifetime
+
+    def valid(self):
+        return self.cookie is not None and self.expires - time.time() > self.refresh_margin
+
+    async def get_cookie(self):
+        if not self.valid():
+            return await self.login()
+
+        if self.refresh_task is None:
+            self._schedule_refresh()
+
+        return self.cookie
+
+    async def login(self, stale=None):
+        async with self.lock:
+            if self.valid() and self.cookie != stale:
+                return self.cookie
+
+            logging.info("Logging in to F1 fantasy")
+            headers = {
+                'apiKey': self.credentials['fantasy']['apikey'],
+                'Content-Type': 'application/json',
+            }
+
+            payload = json.dumps({
+                'Login': self.credentials['fantasy']['username'],
+                'Password': self.credentials['fantasy']['password']
+            })
+
+            response = await self.client.post(self.config['urls']['create_session_url'], data=payload, headers=headers)
+            if response.status_code not in [200, 304]:
+                raise LoginError(response.status_code)
+
+            token = response.json()['data']['subscriptionToken']
+            info = {"data": {"subscriptionToken": token}}
+
+            cookie = parse.quote(json.dumps(info))
+            self.cookie = b64encode(cookie.encode('utf8')).decode('utf8')
+            self.expires = token_expiry(token) or time.time() + self.lifetime
+            with open(self.path, 'w') as outfile:
+                outfile.write(self.cookie)
+
+            self._schedule_refresh()
+            return self.cookie
+
+    def _schedule_refresh(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+
+        delay = max(0, self.expires - time.time() - self.refresh_margin)
+        self.refresh_task = asyncio.ensure_future(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay):
+        await asyncio.sleep(delay)
+        self.refresh_task = None
+        try:
+            await self.login(stale=self.cookie)
+        except Exception:
+            logging.exception("Proactive F1 fantasy login failed")
+
+    async def get(self, url, headers=None, **kwargs):
+        cookie = await self.get_cookie()
+        r = await self.client.get(url, headers={**(headers or {}), 'X-F1-COOKIE-DATA': cookie}, **kwargs)
+        if r.status_code == 401:
+            cookie = await self.login(stale=cookie)
+            r = await self.client.get(url, headers={**(headers or {}), 'X-F1-COOKIE-DATA': cookie}, **kwargs)
+
+        return r
+
+    def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            self.refresh_task = None
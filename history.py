@@ -0,0 +1,252 @@
+import asyncio
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    league TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entrants (
+    league TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    discord_id INTEGER,
+    PRIMARY KEY (league, user_id)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    league TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    score REAL NOT NULL,
+    race_score REAL NOT NULL,
+    turbo TEXT,
+    mega TEXT,
+    stale INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (league, user_id, period)
+);
+CREATE INDEX IF NOT EXISTS scores_version ON scores (league, version, position);
+CREATE TABLE IF NOT EXISTS leaderboard (
+    league TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    score REAL,
+    rank INTEGER,
+    team_name TEXT,
+    PRIMARY KEY (league, user_id)
+);
+CREATE TABLE IF NOT EXISTS picks (
+    league TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    is_team INTEGER NOT NULL,
+    short_name TEXT NOT NULL,
+    name TEXT NOT NULL,
+    price REAL NOT NULL,
+    picked REAL NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (league, user_id, period, slot)
+);
+"""
+
+
+class FantasyHistory:
+    """SQLite store of fantasy scores and picks for every league, player and game period."""
+
+    def __init__(self, path="fantasy.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def version(self, league):
+        with self.lock:
+            row = self.db.execute("SELECT version FROM updates WHERE league = ?", (league,)).fetchone()
+
+        return row["version"] if row else None
+
+    def leaderboard_entry(self, league, user_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT score, rank, team_name FROM leaderboard WHERE league = ? AND user_id = ?",
+                (league, str(user_id))
+            ).fetchone()
+
+        return dict(row) if row else None
+
+    async def writer(self, league):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, HistoryWriter, self.path, league)
+
+    def _details(self, rows, picks):
+        details = {}
+        for row in rows:
+            details[row["user_id"]] = {
+                "id": row["user_id"],
+                "discord_id": row["discord_id"],
+                "name": row["name"],
+                "team": None,
+                "drivers": [],
+                "race_score": row["race_score"],
+                "score": row["score"],
+                "turbo": row["turbo"],
+                "mega": row["mega"],
+                "stale": bool(row["stale"]),
+                "period": row["period"],
+            }
+
+        for pick in picks:
+            entry = details.get(pick["user_id"])
+            if entry is None or pick["period"] != entry["period"]:
+                continue
+
+            info = {key: pick[key] for key in ("short_name", "name", "price", "picked", "score")}
+            if pick["is_team"]:
+                entry["team"] = info
+            else:
+                entry["drivers"].append(info)
+
+        return details
+
+    def league_details(self, league):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT s.*, e.name, e.discord_id FROM scores s "
+                "JOIN entrants e ON e.league = s.league AND e.user_id = s.user_id "
+                "JOIN updates u ON u.league = s.league AND u.version = s.version "
+                "WHERE s.league = ? ORDER BY s.position",
+                (league,)
+            ).fetchall()
+            picks = self.db.execute(
+                "SELECT p.* FROM picks p "
+                "JOIN scores s ON s.league = p.league AND s.user_id = p.user_id AND s.period = p.period "
+                "JOIN updates u ON u.league = s.league AND u.version = s.version "
+                "WHERE p.league = ? ORDER BY p.user_id, p.slot",
+                (league,)
+            ).fetchall()
+
+        return self._details(rows, picks)
+
+    def previous_entrants(self, league):
+        """Leaderboard rows of the entrants in the league's latest update, except those already marked stale."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT l.user_id, l.score, l.rank, l.team_name FROM scores s "
+                "JOIN updates u ON u.league = s.league AND u.version = s.version "
+                "JOIN leaderboard l ON l.league = s.league AND l.user_id = s.user_id "
+                "WHERE s.league = ? AND s.stale = 0 ORDER BY s.position",
+                (league,)
+            ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def player_details(self, league, user_id):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT s.*, e.name, e.discord_id FROM scores s "
+                "JOIN entrants e ON e.league = s.league AND e.user_id = s.user_id "
+                "WHERE s.league = ? AND s.user_id = ? ORDER BY s.period DESC LIMIT 1",
+                (league, str(user_id))
+            ).fetchall()
+            picks = self.db.execute(
+                "SELECT * FROM picks WHERE league = ? AND user_id = ? AND period = ? ORDER BY slot",
+                (league, str(user_id), rows[0]["period"] if rows else None)
+            ).fetchall()
+
+        return self._details(rows, picks).get(str(user_id))
+
+    def player_history(self, league, user_id, limit=5):
+        with self.lock:
+            return self.db.execute(
+                "SELECT period, position, score, race_score, turbo, mega, stale FROM scores "
+                "WHERE league = ? AND user_id = ? ORDER BY period DESC LIMIT ?",
+                (league, str(user_id), limit)
+            ).fetchall()
+
+
+class HistoryWriter:
+    """Stages one league update in temporary tables and publishes it in a single transaction.
+
+    Readers keep seeing the previous update until commit, and the database is only locked while publishing.
+    """
+
+    def __init__(self, path, league):
+        self.league = league
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        for table in ("entrants", "leaderboard", "scores", "picks"):
+            self.db.execute(f"CREATE TEMP TABLE stage_{table} AS SELECT * FROM main.{table} WHERE 0")
+
+    async def add(self, entrants):
+        await asyncio.get_event_loop().run_in_executor(None, self._add, entrants)
+
+    def _add(self, entrants):
+        league = self.league
+        with self.db:
+            for entrant in entrants:
+                period = entrant.period or 0
+                self.db.execute(
+                    "INSERT INTO stage_entrants (league, user_id, name, discord_id) VALUES (?, ?, ?, ?)",
+                    (league, entrant.id, entrant.name, entrant.discord_id)
+                )
+                self.db.execute(
+                    "INSERT INTO stage_leaderboard (league, user_id, score, rank, team_name) VALUES (?, ?, ?, ?, ?)",
+                    (league, entrant.id) + entrant.snapshot
+                )
+                self.db.execute(
+                    "INSERT INTO stage_scores "
+                    "(league, user_id, period, version, position, score, race_score, turbo, mega, stale) "
+                    "VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?)",
+                    (league, entrant.id, period, entrant.position, entrant.score, entrant.race_score,
+                     entrant.turbo, entrant.mega, int(entrant.stale))
+                )
+
+                if entrant.team is None:
+                    continue
+
+                self.db.executemany(
+                    "INSERT INTO stage_picks "
+                    "(league, user_id, period, slot, is_team, short_name, name, price, picked, score) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (league, entrant.id, period, slot, int(slot == len(entrant.drivers))) + pick
+                        for slot, pick in enumerate(entrant.drivers + [entrant.team])
+                    ]
+                )
+
+    async def commit(self):
+        await asyncio.get_event_loop().run_in_executor(None, self._commit)
+
+    def _commit(self):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(
+                "INSERT INTO updates (league, version) VALUES (?, 1) "
+                "ON CONFLICT (league) DO UPDATE SET version = version + 1",
+                (self.league,)
+            )
+            self.db.execute("INSERT OR REPLACE INTO main.entrants SELECT * FROM stage_entrants")
+            self.db.execute("INSERT OR REPLACE INTO main.leaderboard SELECT * FROM stage_leaderboard")
+            self.db.execute(
+                "INSERT OR REPLACE INTO main.scores "
+                "SELECT league, user_id, period, (SELECT version FROM updates WHERE league = ?), "
+                "position, score, race_score, turbo, mega, stale FROM stage_scores",
+                (self.league,)
+            )
+            self.db.execute(
+                "DELETE FROM main.picks WHERE (league, user_id, period) IN "
+                "(SELECT DISTINCT league, user_id, period FROM stage_picks)"
+            )
+            self.db.execute("INSERT OR REPLACE INTO main.picks SELECT * FROM stage_picks")
+
+        self.db.close()
+
+    async def rollback(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.db.close)
@@ -0,0 +1,91 @@
+class EmojiIndex:
+    """Custom emojis of every guild the bot is in, by case-folded name."""
+
+    def __init__(self):
+        self.guilds = {}
+        self.names = {}
+
+    def rebuild(self, guilds):
+        self.guilds = {guild.id: list(guild.emojis) for guild in guilds}
+        self._reindex()
+
+    def update_guild(self, guild, emojis):
+        self.guilds[guild.id] = list(emojis)
+        self._reindex()
+
+    def remove_guild(self, guild):
+        self.guilds.pop(guild.id, None)
+        self._reindex()
+
+    def _reindex(self):
+        names = {}
+        for emojis in self.guilds.values():
+            for emoji in emojis:
+                names.setdefault(emoji.name.casefold(), emoji)
+
+        self.names = names
+
+    def get(self, name):
+        return self.names.get(name.casefold())
+
+
+def get_emoji_index(bot):
+    if getattr(bot, "emoji_index", None) is None:
+        bot.emoji_index = EmojiIndex()
+        bot.emoji_index.rebuild(bot.guilds)
+
+    return bot.emoji_index
+
+
+class ChannelIndex:
+    """Guilds and their text channels by name, as used to address messages from commands."""
+
+    def __init__(self):
+        self.known = {}
+        self.guilds = {}
+        self.channels = {}
+
+    def rebuild(self, guilds):
+        self.known = {guild.id: guild for guild in guilds}
+        self.channels = {}
+        for guild in guilds:
+            self.index_guild(guild)
+        self._reindex()
+
+    def add_guild(self, guild):
+        self.known[guild.id] = guild
+        self.index_guild(guild)
+        self._reindex()
+
+    def remove_guild(self, guild):
+        self.known.pop(guild.id, None)
+        self.channels.pop(guild.id, None)
+        self._reindex()
+
+    def index_guild(self, guild):
+        channels = {}
+        for channel in guild.text_channels:
+            channels.setdefault(channel.name, channel)
+        self.channels[guild.id] = channels
+
+    def _reindex(self):
+        guilds = {}
+        for guild in self.known.values():
+            guilds.setdefault(guild.name, guild)
+
+        self.guilds = guilds
+
+    def find(self, guild, channel):
+        guild_obj = self.guilds.get(guild)
+        if guild_obj is None:
+            return None
+
+        return self.channels.get(guild_obj.id, {}).get(channel)
+
+
+def get_channel_index(bot):
+    if getattr(bot, "channel_index", None) is None:
+        bot.channel_index = ChannelIndex()
+        bot.channel_index.rebuild(bot.guilds)
+
+    return bot.channel_index
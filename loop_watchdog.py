@@ -0,0 +1,120 @@
+import asyncio
+import contextvars
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from metrics import metrics
+
+metrics.describe("rlmbot_loop_lag_seconds", "Event loop scheduling delay.")
+metrics.describe("rlmbot_loop_stalls_total", "Event loop stalls by the command or task that was running.")
+
+# Set for the task invoking a command; tasks it starts (single flight loads, fantasy fetches) inherit it.
+# The monitor thread can't read another task's context, so each task's value is recorded when it is created.
+current_command = contextvars.ContextVar("current_command", default=None)
+
+
+class LoopWatchdog:
+    """Measures event loop lag and reports stalls with the loop thread's stack and the running command.
+
+    A heartbeat task on the loop records when it last ran; a monitor thread notices when it stops
+    running for longer than `threshold` and captures what the loop thread is doing at that moment.
+    """
+
+    def __init__(self, loop, interval=0.25, threshold=1.0):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = None
+        self.commands = weakref.WeakKeyDictionary()
+        self.task_factory = None
+        self.thread_id = None
+        self.task = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.task_factory = self.loop.get_task_factory()
+        self.loop.set_task_factory(self._create_task)
+        self.task = self.loop.create_task(self._beat())
+        threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.loop.set_task_factory(self.task_factory)
+        if self.task is not None:
+            self.task.cancel()
+
+    async def command_started(self, ctx):
+        current_command.set(ctx.command.qualified_name)
+        self.commands[asyncio.current_task()] = ctx.command.qualified_name
+
+    async def command_finished(self, ctx):
+        current_command.set(None)
+        self.commands.pop(asyncio.current_task(), None)
+
+    def _create_task(self, loop, coro, **kwargs):
+        if self.task_factory is not None:
+            task = self.task_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+
+        context = kwargs.get("context")
+        command = context.get(current_command) if context is not None else current_command.get()
+        if command is not None:
+            self.commands[task] = command
+
+        return task
+
+    async def _beat(self):
+        self.heartbeat = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            metrics.observe("rlmbot_loop_lag_seconds", max(0.0, now - expected))
+
+    def _running(self):
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+
+        if task is None:
+            return "unknown"
+
+        command = self.commands.get(task)
+        if command is not None:
+            return command
+
+        coro = task.get_coro()
+        return f"task:{getattr(coro, '__qualname__', task.get_name())}"
+
+    def _monitor(self):
+        reported = None
+        stalled_since = None
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            if heartbeat is None:
+                continue
+
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold:
+                if reported is not None:
+                    logging.warning(f"Event loop resumed after {heartbeat - stalled_since:.2f}s stalled in {reported}")
+                    reported = None
+                continue
+
+            if reported is not None:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            reported = self._running()
+            stalled_since = heartbeat
+            metrics.inc("rlmbot_loop_stalls_total", command=reported)
+            logging.warning(f"Event loop blocked for {blocked:.2f}s in {reported}\n{stack}")
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+
+class Metrics:
+    """Process-wide counters, gauges and histograms, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[series_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def series(self, kind, name):
+        """(labels, value) pairs of one metric, labels as a dict."""
+        with self.lock:
+            source = {"counter": self.counters, "gauge": self.gauges, "histogram": self.histograms}[kind]
+            return [(dict(labels), value) for (metric, labels), value in source.items() if metric == name]
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, source in (("counter", self.counters), ("gauge", self.gauges), ("histogram", self.histograms)):
+                names = sorted({name for name, _ in source})
+                for name in names:
+                    if name in self.help:
+                        lines.append(f"# HELP {name} {self.help[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, labels), value in sorted(source.items(), key=lambda item: item[0]):
+                        if metric != name:
+                            continue
+                        if kind != "histogram":
+                            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                            continue
+
+                        cumulative = 0
+                        for bound, count in zip(value.buckets, value.counts):
+                            cumulative += count
+                            le = "+Inf" if bound == float("inf") else format_value(bound)
+                            lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {format_value(value.sum)}")
+                        lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as outfile:
+            outfile.write(self.render())
+        os.replace(tmp, path)
+
+
+def series_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+metrics.describe("rlmbot_command_duration_seconds", "Time taken by each bot command.")
+metrics.describe("rlmbot_commands_total", "Commands completed.")
+metrics.describe("rlmbot_http_request_duration_seconds", "HTTP request latency by host.")
+metrics.describe("rlmbot_http_requests_total", "HTTP requests by host, method and status.")
+metrics.describe("rlmbot_cache_requests_total", "Cache lookups by cache and result.")
+metrics.describe("rlmbot_fantasy_refresh_duration_seconds", "Time taken by each fantasy league refresh.")
+metrics.describe("rlmbot_fantasy_refreshes_total", "Fantasy league refreshes by result.")
+metrics.describe("rlmbot_fantasy_entrants_total", "Fantasy entrants processed by outcome.")
+metrics.describe("rlmbot_fantasy_entrants_per_second", "Entrant throughput of the last fantasy refresh.")
@@ -0,0 +1,109 @@
+import bisect
+import unicodedata
+from collections import Counter
+
+
+def normalize(name):
+    """Case-fold a name and strip accents so 'Pérez' and 'perez' compare equal."""
+    decomposed = unicodedata.normalize("NFKD", name)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def trigrams(value):
+    padded = f"  {value} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Finds names by exact match, word prefix, substring or trigram similarity, preferring earlier entries on ties."""
+
+    def __init__(self, names, threshold=0.3):
+        self.names = list(names)
+        self.threshold = threshold
+        self.exact = {}
+        self.normalized = []
+        self.prefixes = []
+        self.postings = {}
+        self.entries = []
+
+        for position, name in enumerate(self.names):
+            value = normalize(name)
+            self.normalized.append(value)
+            self.exact.setdefault(value, position)
+            for word in {value, *value.split()}:
+                self.prefixes.append((word, position))
+
+                grams = trigrams(word)
+                for gram in grams:
+                    self.postings.setdefault(gram, []).append(len(self.entries))
+                self.entries.append((position, len(grams)))
+
+        self.prefixes.sort()
+
+    def _prefix(self, value):
+        start = bisect.bisect_left(self.prefixes, (value, -1))
+        best = None
+        for i in range(start, len(self.prefixes)):
+            word, position = self.prefixes[i]
+            if not word.startswith(value):
+                break
+            if best is None or position < best:
+                best = position
+
+        return best
+
+    def _substring(self, value):
+        # Every name containing the query holds all of its unpadded trigrams, so only those names are checked.
+        inner = {value[i:i + 3] for i in range(len(value) - 2)}
+        if inner:
+            candidates = None
+            for gram in inner:
+                positions = {self.entries[entry][0] for entry in self.postings.get(gram, ())}
+                candidates = positions if candidates is None else candidates & positions
+            candidates = sorted(candidates)
+        else:
+            candidates = range(len(self.names))
+
+        for position in candidates:
+            if value in self.normalized[position]:
+                return position
+
+        return None
+
+    def _similar(self, value):
+        grams = trigrams(value)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        best = None
+        for entry, count in shared.items():
+            position, size = self.entries[entry]
+            score = count / (len(grams) + size - count)
+            if best is None or (score, -position) > (best[0], -best[1]):
+                best = (score, position)
+
+        return best if best is not None and best[0] >= self.threshold else None
+
+    def match(self, query):
+        """Return (score, position) for the best match, or None; exact scores 3, prefix 2, substring 1.5, similarity 0-1."""
+        value = normalize(query)
+        if not value:
+            return None
+
+        if value in self.exact:
+            return 3, self.exact[value]
+
+        position = self._prefix(value)
+        if position is not None:
+            return 2, position
+
+        position = self._substring(value)
+        if position is not None:
+            return 1.5, position
+
+        return self._similar(value)
+
+    def find(self, query):
+        result = self.match(query)
+        return result[1] if result else None
@@ -0,0 +1,104 @@
+from collections import Counter
+
+from search import NameIndex
+
+COLUMNS = (
+    "driver", "qualifying_position", "race_position", "points", "dnf_reason",
+    "qualifying_penalty_dsq", "qualifying_penalty_grid", "qualifying_penalty_bog", "qualifying_penalty_sfp",
+    "race_penalty_dsq", "race_penalty_time", "race_penalty_positions", "penalty_points",
+    "laps_completed", "laps_lead", "fastest_lap",
+)
+
+TOTALS = (
+    "qualifying_penalty_dsq", "qualifying_penalty_grid", "qualifying_penalty_bog", "qualifying_penalty_sfp",
+    "race_penalty_dsq", "race_penalty_time", "race_penalty_positions", "penalty_points",
+    "laps_completed", "laps_lead",
+)
+
+
+class SeasonResults:
+    """One season of race results stored column by column, with the row numbers of each driver."""
+
+    def __init__(self, results):
+        self.columns = {column: [] for column in COLUMNS}
+        for result in results:
+            for column, values in self.columns.items():
+                values.append(result.get(column))
+
+        self.rows = {}
+        for row, driver in enumerate(self.columns["driver"]):
+            self.rows.setdefault(driver, []).append(row)
+
+        self.index = NameIndex(self.rows)
+
+    def __len__(self):
+        return len(self.columns["driver"])
+
+    def select(self, column, rows):
+        values = self.columns[column]
+        return [values[row] for row in rows]
+
+
+def aggregate(name, tables):
+    """Career stats for one driver over several seasons, in the same shape as /api/stats."""
+    columns = {column: [] for column in COLUMNS}
+    for table in tables:
+        rows = table.rows.get(name, [])
+        for column in COLUMNS:
+            columns[column].extend(table.select(column, rows))
+
+    qualifying = [q for q in columns["qualifying_position"] if q]
+    dnfs = [reason for reason in columns["dnf_reason"] if reason]
+    finishes = [
+        position for position, reason in zip(columns["race_position"], columns["dnf_reason"])
+        if position and not reason
+    ]
+    qualifying_counts = Counter(qualifying)
+    finish_counts = Counter(finishes)
+
+    stats = {
+        "name": name,
+        "attendance": len(columns["driver"]),
+        "points_finishes": sum(1 for points in columns["points"] if points),
+        "qualifying_positions": qualifying,
+        "avg_qualifying": sum(qualifying) / len(qualifying) if qualifying else 0,
+        "pole_positions": qualifying_counts[1],
+        "race_positions": finishes,
+        "avg_race": sum(finishes) / len(finishes) if finishes else 0,
+        "best_finish": min(finishes) if finishes else 0,
+        "wins": finish_counts[1],
+        "podiums": finish_counts[1] + finish_counts[2] + finish_counts[3],
+        "dnf_reasons": dnfs,
+        "fastest_laps": sum(1 for fastest in columns["fastest_lap"] if fastest),
+    }
+    for column in TOTALS:
+        stats[column] = sum(value or 0 for value in columns[column])
+
+    return stats
+
+
+class StatsEngine:
+    """Season result tables kept in memory and rebuilt only when the cached response changes."""
+
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, season_id, version, load):
+        cached = self.tables.get(season_id)
+        if cached is None or cached[0] != version:
+            cached = (version, SeasonResults(load()))
+            self.tables[season_id] = cached
+
+        return cached[1]
+
+    def stats(self, driver, tables):
+        best = None
+        for table in tables:
+            result = table.index.match(driver)
+            if result is not None and (best is None or result[0] > best[0]):
+                best = (result[0], table.index.names[result[1]])
+
+        if best is None:
+            return {}
+
+        return aggregate(best[1], tables)
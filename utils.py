@@ -1,29 +1,71 @@
 from inflect import engine
 import json
-from urllib import parse
-from base64 import b64encode
-import requests
+from email.utils import parsedate_to_datetime
+import aiohttp
+import asyncio
 import os
-from datetime import datetime
-import time
+from datetime import datetime, timezone
+import random
 import re
+import time
 from itertools import zip_longest
 import logging
 import sys, traceback
+from collections import namedtuple
+from f1session import LoginError
+from indexes import get_emoji_index
+from metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 p = engine()
 
 logging.basicConfig(filename='fantasy_info.log', level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
 
 
-class Entrant:
-    def __init__(self, config, league, cookie, headers, info):
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def loads(content):
+    if orjson is not None:
+        return orjson.loads(content)
+
+    return json.loads(content)
+
+
+LEADERBOARD_KEYS = ('score', 'rank', 'team_name')
+
+Pick = namedtuple("Pick", ["short_name", "name", "price", "picked", "score"])
+
+
+class FantasyContext:
+    __slots__ = ("config", "league", "headers", "session", "team_cache")
+
+    def __init__(self, config, league, headers, session, team_cache=None):
         self.config = config
         self.league = league
-        self.cookie = cookie
         self.headers = headers
+        self.session = session
+        self.team_cache = team_cache
+
+
+class Entrant:
+    __slots__ = (
+        "id", "name", "discord_id", "position", "snapshot", "retry", "retry_after", "stale",
+        "team", "drivers", "turbo", "mega", "race_score", "score", "period"
+    )
 
+    def __init__(self, league, info):
         self.retry = False
+        self.retry_after = None
+        self.stale = False
 
         self.team = None
         self.drivers = []
@@ -31,6 +73,10 @@ class Entrant:
         self.mega = None
         self.race_score = 0
         self.score = 0
+        self.period = None
+
+        self.position = None
+        self.snapshot = tuple(info.get(key) for key in LEADERBOARD_KEYS)
 
         self.discord_id = None
         self.id = str(info['user_id'])
@@ -40,71 +86,199 @@ class Entrant:
             self.name = league['players'][self.id]['name']
             self.discord_id = league['players'][self.id]['id']
 
-    def retrieve_info(self):
+    async def _get(self, context, url):
+        try:
+            r = await context.session.get(url, headers=context.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError, LoginError) as e:
+            logging.info(f"Request failed - {e!r}")
+            self.retry = True
+            return None
+
+        if r.status_code not in [200, 304]:
+            self.retry = True
+            if r.status_code in [429, 503]:
+                self.retry_after = parse_retry_after(r.headers.get('Retry-After'))
+
+        return r
+
+    async def picked_team(self, context, team_info):
+        team_cache = context.team_cache
+        period = team_info.get('game_period_id')
+        key = f"{period}-{team_info['picked_team_id']}"
+        final = team_cache is not None and team_cache.is_final(period)
+        if final:
+            cached = team_cache.get(key)
+            if cached is not None:
+                return cached
+
+        tr = await self._get(context, context.config['urls']['team_url'].format(team_info['picked_team_id']))
+        if tr is None or self.retry:
+            if tr is not None:
+                logging.info(f"[team] HTTP status code - {tr.status_code}")
+            return None
+
+        # The live period's team is stored on every fetch so its last version is on disk once the next period opens.
+        tc = loads(tr.content)
+        if team_cache is not None and period is not None and isinstance(tc.get('picked_team'), dict):
+            team_cache.set(key, tc)
+
+        return tc
+
+    async def retrieve_info(self, context):
         logging.info(f"Getting player info - {self.name}")
         self.retry = False
+        self.retry_after = None
+        self.team = None
+        self.drivers = []
 
-        r = requests.get(self.config['urls']['user_url'].format(self.id), headers=self.headers)
-        if r.status_code in [200, 304]:
-            content = json.loads(r.content.decode('utf-8'))
-            self.score = content['user']['leaderboard_positions']['slot_1'][self.league['f1_id']]['score']
-
-            logging.info(f"Getting team info")
-            team_id = content["user"]["historical_picked_teams_info"]["slot_1"]["historical_team_info"][-1]["picked_team_id"]
-            tr = requests.get(self.config['urls']['team_url'].format(team_id), headers=self.headers)
-            if tr.status_code in [200, 304]:
-                tc = json.loads(tr.content.decode("utf-8"))
-                self.race_score = tc['picked_team']['score']
-                for entry in tc['picked_team']['picked_players']:
-                    driver = self.config['fantasy']['drivers_teams'][str(entry["player"]["id"])]
-
-                    if entry["player"]["position_id"] == 2:
-                        self.team = {
-                            "short_name": entry["player"]["external_id"][-3:],
-                            "name": entry["player"]["display_name"],
-                            "price": entry["player"]["price"],
-                            "picked": entry["player"]["current_price_change_info"]["current_selection_percentage"],
-                            "score": entry["score"]
-                        }
-                    else:
-                        self.drivers.append({
-                            "short_name": entry["player"]["external_id"][3:6],
-                            "name": entry["player"]["display_name"],
-                            "price": entry["player"]["price"],
-                            "picked": entry["player"]["current_price_change_info"]["current_selection_percentage"],
-                            "score": entry["score"]
-                        })
-
-                        if str(tc['picked_team']['boosted_player_id']) in self.config['fantasy']['drivers_teams']:
-                            self.turbo = self.config['fantasy']['drivers_teams'][str(tc['picked_team']['boosted_player_id'])]
-
-                        if str(tc['picked_team']['mega_boosted_player_id']) in self.config['fantasy']['drivers_teams']:
-                            self.mega = self.config['fantasy']['drivers_teams'][str(tc['picked_team']['mega_boosted_player_id'])]
-            else:
-                logging.info(f"[team] HTTP status code - {r.status_code}")
+        drivers_teams = context.config['fantasy']['drivers_teams']
+        r = await self._get(context, context.config['urls']['user_url'].format(self.id))
+        if r is not None and not self.retry:
+            try:
+                content = loads(r.content)
+                self.score = content['user']['leaderboard_positions']['slot_1'][context.league['f1_id']]['score']
+
+                logging.info(f"Getting team info")
+                history = content["user"]["historical_picked_teams_info"]["slot_1"]["historical_team_info"]
+                self.period = history[-1].get('game_period_id')
+                if context.team_cache is not None:
+                    context.team_cache.observe(self.period)
+                tc = await self.picked_team(context, history[-1])
+                if tc is not None:
+                    self.race_score = tc['picked_team']['score']
+                    for entry in tc['picked_team']['picked_players']:
+                        player = entry["player"]
+                        if player["position_id"] == 2:
+                            short_name = player["external_id"][-3:]
+                        else:
+                            short_name = player["external_id"][3:6]
+
+                        pick = Pick(
+                            short_name,
+                            player["display_name"],
+                            player["price"],
+                            player["current_price_change_info"]["current_selection_percentage"],
+                            entry["score"]
+                        )
+                        if player["position_id"] == 2:
+                            self.team = pick
+                        else:
+                            self.drivers.append(pick)
+
+                    self.turbo = drivers_teams.get(str(tc['picked_team']['boosted_player_id']))
+                    self.mega = drivers_teams.get(str(tc['picked_team']['mega_boosted_player_id']))
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                logging.info(f"Unexpected response for {self.name} - {e!r}")
                 self.retry = True
+                self.team = None
+                self.drivers = []
+                return
 
             print(f"{self.name} collected")
-        else:
+        elif r is not None:
             logging.info(f"[user] HTTP status code - {r.status_code}")
-            self.retry = True
-
 
-class EntrantEncoder(json.JSONEncoder):
-    def default(self, entrant):
+    def load(self, previous):
+        self.team = Pick(**previous['team']) if previous['team'] else None
+        self.drivers = [Pick(**driver) for driver in previous['drivers']]
+        self.race_score = previous['race_score']
+        self.score = previous['score']
+        self.turbo = previous['turbo']
+        self.mega = previous['mega']
+        self.period = previous.get('period')
+
+    def restore(self, previous):
+        self.stale = True
+        if previous is not None:
+            self.load(previous)
+
+    def to_dict(self):
         return {
-            "id": entrant.id,
-            "discord_id": entrant.discord_id,
-            "name": entrant.name,
-            "team": entrant.team,
-            "drivers": entrant.drivers,
-            "race_score": entrant.race_score,
-            "score": entrant.score,
-            "turbo": entrant.turbo,
-            "mega": entrant.mega
+            "id": self.id,
+            "discord_id": self.discord_id,
+            "name": self.name,
+            "team": self.team._asdict() if self.team else None,
+            "drivers": [driver._asdict() for driver in self.drivers],
+            "race_score": self.race_score,
+            "score": self.score,
+            "turbo": self.turbo,
+            "mega": self.mega,
+            "stale": self.stale,
+            "period": self.period
         }
 
 
+class ProgressReporter:
+    def __init__(self, msg, total, interval=5):
+        self.msg = msg
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.last = None
+        self.task = None
+
+    def start(self):
+        if self.msg is not None:
+            self.task = asyncio.ensure_future(self._run())
+
+    def advance(self, failed=False):
+        self.done += 1
+        if failed:
+            self.failed += 1
+
+    def summary(self):
+        content = f"Updating: {self.done}/{self.total} done, {self.failed} failed"
+        if 0 < self.done < self.total:
+            eta = (time.monotonic() - self.started) / self.done * (self.total - self.done)
+            content = f"{content}, about {int(eta) + 1}s left"
+
+        return content
+
+    async def _edit(self):
+        content = self.summary()
+        if content == self.last:
+            return
+
+        self.last = content
+        try:
+            await self.msg.edit(content=content)
+        except Exception:
+            logging.exception("Progress update failed")
+
+    async def _run(self):
+        while True:
+            await self._edit()
+            await asyncio.sleep(self.interval)
+
+    async def finish(self):
+        if self.task is not None:
+            self.task.cancel()
+            await self._edit()
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, base, cap):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
 def format_float(num):
     return format(num, ".15g")
 
@@ -161,9 +335,9 @@ def format_delta(delta):
     return string_delta
 
 
-def get_current_season(division, bot):
+async def get_current_season(division, bot):
     if division.lower() not in bot.config["division_season"]:
-        r = bot.session.get(f"{bot.config['urls']['base_url']}/api/info/{division.lower()}")
+        r = await bot.client.get(f"{bot.config['urls']['base_url']}/api/info/{division.lower()}")
         info = json.loads(r.content)
         if "season" not in info:
             return False
@@ -177,105 +351,230 @@ def get_current_season(division, bot):
     return True
 
 
-def generate_f1_cookie(config, credentials):
-    try:
-        mtime = datetime.fromtimestamp(os.stat('cookie.txt').st_mtime)
-        now = datetime.now()
-        regenerate = (now - mtime).days > 1
-    except FileNotFoundError:
-        regenerate = True
-
-    if regenerate:
-        print('Regenerating cookie')
-        headers = {
-            'apiKey': credentials['fantasy']['apikey'],
-            'Content-Type': 'application/json',
-        }
+def leaderboard_changed(entrant, previous):
+    if previous is None:
+        return True
 
-        payload = json.dumps({
-            'Login': credentials['fantasy']['username'],
-            'Password': credentials['fantasy']['password']
-        })
+    return entrant.snapshot != tuple(previous[key] for key in LEADERBOARD_KEYS)
 
-        response = requests.post(config['urls']['create_session_url'], data=payload, headers=headers)
-        if response.status_code not in [200, 304]:
-            return False
 
-        body = json.loads(response.content.decode('utf-8'))
+class LeaderboardError(Exception):
+    pass
 
-        info = {"data": {"subscriptionToken": body['data']['subscriptionToken']}}
 
-        cookie = parse.quote(json.dumps(info))
-        b64cookie = b64encode(cookie.encode('utf8')).decode('utf8')
-        with open('cookie.txt', 'w') as outfile:
-            outfile.write(b64cookie)
-        return b64cookie
-    else:
-        print('Using stored cookie')
-        with open('cookie.txt') as infile:
-            return infile.read().strip()
+class JSONStream:
+    """Writes a JSON array, or an object when keys are given, one element at a time."""
+
+    def __init__(self, path, keyed=False):
+        self.path = path
+        self.keyed = keyed
+        self.first = True
+        self.outfile = open(f"{path}.tmp", 'wb')
+        self.outfile.write(b'{' if keyed else b'[')
+
+    def add(self, value, key=None):
+        if not self.first:
+            self.outfile.write(b',')
+        self.first = False
+
+        if self.keyed:
+            self.outfile.write(dumps(key) + b':')
+        self.outfile.write(dumps(value))
+
+    def commit(self):
+        self.outfile.write(b'}' if self.keyed else b']')
+        self.outfile.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def abort(self):
+        self.outfile.close()
+        os.remove(f"{self.path}.tmp")
+
+
+def load_details(path):
+    with open(path, 'rb') as infile:
+        return loads(infile.read())
+
 
+async def leaderboard_pages(session, config, league, headers):
+    size = config.get('fantasy_update', {}).get('page_size', 100)
+    page = 1
+    first = None
+    while True:
+        logging.info(f"Requesting league info (page {page})")
+        url = config['urls']['league_url'].format(league=league['f1_id'], page=page, size=size)
+        try:
+            r = await session.get(url, headers=headers)
+        except LoginError as e:
+            raise LeaderboardError(e)
 
-async def update_fantasy_details(msg, league, config, f1_cookie):
+        if r.status_code not in [200, 304]:
+            logging.info(f"HTTP status code - {r.status_code}")
+            raise LeaderboardError(r.status_code)
+
+        entrants = loads(r.content)['leaderboard']['leaderboard_entrants']
+        if not entrants or entrants[0]['user_id'] == first:
+            return
+
+        yield entrants
+
+        if len(entrants) < size:
+            return
+
+        first = entrants[0]['user_id']
+        page += 1
+
+
+async def update_fantasy_details(msg, league, config, session, history, full=False, team_cache=None):
     headers = {
-        'X-F1-COOKIE-DATA': f1_cookie,
         'User-Agent': 'VirtualWDCPC F1 Fantasy Discord Bot v0.1'
     }
 
-    logging.info("Requesting league info")
-    r = requests.get(config['urls']['league_url'].format(league['f1_id']), headers=headers)
-    if r.status_code in [200, 304]:
-        content = json.loads(r.content.decode('utf-8'))
-        entrants = content['leaderboard']['leaderboard_entrants']
-        details = {}
-    else:
-        logging.info(f"HTTP status code - {r.status_code}")
-        return False
-
-    retry = []
-
-    logging.info("Filtering entrants")
-    filtered_entrants = [x for x in entrants if str(x['user_id']) not in league['ignore']]
-    for _, info in enumerate(filtered_entrants):
-        entrant = Entrant(config, league, f1_cookie, headers, info)
-
-        await msg.edit(content=f"Updating: {entrant.name}")
-        entrant.retrieve_info()
-        if entrant.retry:
-            retry.append(entrant)
-
-        details[entrant.id] = entrant
-        time.sleep(1)
-
-    while len(retry) > 0:
-        time.sleep(5)
-        logging.info("Processing retries")
-        for entrant in retry:
-            await msg.edit(content=f"Updating: {entrant.name}")
-            entrant.retrieve_info()
+    settings = config.get('fantasy_update', {})
+    max_attempts = settings.get('max_attempts', 5)
+    concurrency = settings.get('concurrency', 8)
+    semaphore = asyncio.Semaphore(concurrency)
+    window = asyncio.Queue(settings.get('window', concurrency * 4))
+    ignore = league.get('ignore', [])
+    context = FantasyContext(config, league, headers, session, team_cache)
+    full = full or history.version(league['tag']) is None
+
+    async def fetch(entrant):
+        for attempt in range(max_attempts):
+            async with semaphore:
+                await entrant.retrieve_info(context)
+
             if not entrant.retry:
-                retry.remove(entrant)
-            details[entrant.id] = entrant
-            time.sleep(1)
+                progress.advance()
+                return entrant
+
+            if attempt + 1 < max_attempts:
+                backoff_max = settings.get('backoff_max', 60)
+                if entrant.retry_after is not None:
+                    delay = min(entrant.retry_after, backoff_max)
+                else:
+                    delay = backoff_delay(attempt, settings.get('backoff_base', 1), backoff_max)
+                logging.info(f"Retrying {entrant.name} in {delay:.1f}s (attempt {attempt + 1}/{max_attempts})")
+                await asyncio.sleep(delay)
+
+        logging.info(f"Giving up on {entrant.name} after {max_attempts} attempts")
+        entrant.restore(history.player_details(league['tag'], entrant.id))
+        progress.advance(failed=True)
+        return entrant
+
+    async def produce(snapshot):
+        position = 0
+        seen = set()
+        async for entrants in leaderboard_pages(session, config, league, headers):
+            for info in entrants:
+                # A leaderboard reordering between pages can repeat an entrant on the next page.
+                if str(info['user_id']) in ignore or str(info['user_id']) in seen:
+                    continue
+
+                seen.add(str(info['user_id']))
+
+                snapshot.add(info)
+                position += 1
+                entrant = Entrant(league, info)
+                entrant.position = position
+
+                earlier = None if full else history.player_details(league['tag'], entrant.id)
+                if earlier is None or earlier['stale'] or leaderboard_changed(entrant, history.leaderboard_entry(league['tag'], entrant.id)):
+                    progress.total += 1
+                    task = asyncio.ensure_future(fetch(entrant))
+                else:
+                    entrant.load(earlier)
+                    task = asyncio.get_event_loop().create_future()
+                    task.set_result(entrant)
+
+                await window.put(task)
+
+        # It can also skip an entrant who moves up across a page boundary while the pages are read, so
+        # anyone in the previous update that wasn't seen keeps their last known details, marked stale.
+        for info in history.previous_entrants(league['tag']):
+            if info['user_id'] in ignore or info['user_id'] in seen:
+                continue
+
+            position += 1
+            entrant = Entrant(league, info)
+            entrant.position = position
+            entrant.restore(history.player_details(league['tag'], entrant.id))
+            logging.info(f"Carrying forward {entrant.name}, missing from the leaderboard pages")
+            task = asyncio.get_event_loop().create_future()
+            task.set_result(entrant)
+            await window.put(task)
+
+        await window.put(None)
+
+    async def consume(writer, details):
+        batch = []
+        processed = 0
+        while True:
+            task = await window.get()
+            if task is not None:
+                entrant = await task
+                details.add(entrant.to_dict(), entrant.id)
+                batch.append(entrant)
+                processed += 1
+
+            if batch and (task is None or len(batch) >= concurrency):
+                await writer.add(batch)
+                batch = []
+
+            if task is None:
+                return processed
+
+    progress = ProgressReporter(msg, 0, settings.get('progress_interval', 5))
+    writer = await history.writer(league['tag'])
+    snapshot = JSONStream(f"{league['tag']}.json")
+    details = JSONStream(f"{league['tag']}-details.json", keyed=True)
+    pipeline = [asyncio.ensure_future(produce(snapshot)), asyncio.ensure_future(consume(writer, details))]
+
+    progress.start()
+    try:
+        _, processed = await asyncio.gather(*pipeline)
+    except BaseException as e:
+        for task in pipeline:
+            task.cancel()
+        while not window.empty():
+            task = window.get_nowait()
+            if task is not None:
+                task.cancel()
+
+        snapshot.abort()
+        details.abort()
+        await writer.rollback()
+        if isinstance(e, LeaderboardError):
+            return False
+        raise
+    finally:
+        await progress.finish()
 
-    with open(f"{league['tag']}.json", 'w') as outfile:
-        json.dump(filtered_entrants, outfile, indent=4)
+    snapshot.commit()
+    details.commit()
+    await writer.commit()
+    logging.info(f"Refreshed {progress.total} entrants")
 
-    with open(f"{league['tag']}-details.json", 'w') as outfile:
-        json.dump(details, outfile, cls=EntrantEncoder, indent=4)
+    tag = league['tag']
+    metrics.inc("rlmbot_fantasy_entrants_total", progress.total - progress.failed, league=tag, outcome="fetched")
+    metrics.inc("rlmbot_fantasy_entrants_total", progress.failed, league=tag, outcome="failed")
+    metrics.inc("rlmbot_fantasy_entrants_total", processed - progress.total, league=tag, outcome="unchanged")
+    metrics.set("rlmbot_fantasy_entrants_per_second", processed / max(time.monotonic() - progress.started, 1e-6), league=tag)
 
     return True
 
 
+EMOJI_PATTERN = re.compile(r'(?<![<\w]):(\w+):')
+
+
 def find_emojis(msg, bot):
-    try:
-        for this_emoji in re.findall(r':([^:]+):', msg):
-            emoji = next(iter([(e.id, e.name) for e in bot.emojis if e.name.lower() == this_emoji.lower()]))
-            msg = re.sub(r':{}:'.format(this_emoji), '<:{}:{}>'.format(emoji[1], emoji[0]), msg)
-    except StopIteration:
-        pass
+    index = get_emoji_index(bot)
+
+    def replace(match):
+        emoji = index.get(match.group(1))
+        return str(emoji) if emoji is not None else match.group(0)
 
-    return msg
+    return EMOJI_PATTERN.sub(replace, msg)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from metrics import metrics
+
+
+class Response:
+    __slots__ = ("url", "status_code", "headers", "content")
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts of up to `burst` (at least one)."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = max(1, burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class WebClient:
+    """Shared HTTP client keeping one pooled keep-alive session per host."""
+
+    def __init__(self, config=None, rate_limits=None):
+        config = config or {}
+        self.limit_per_host = config.get("limit_per_host", 10)
+        self.timeout = config.get("timeout", 30)
+        self.hosts = config.get("hosts", {})
+        self.sessions = {}
+        self.limiters = {
+            host: TokenBucket(limit["rate"], limit.get("burst"))
+            for host, limit in (rate_limits or {}).items()
+        }
+
+    def _session(self, host):
+        session = self.sessions.get(host)
+        if session is None or session.closed:
+            settings = self.hosts.get(host, {})
+            connector = aiohttp.TCPConnector(
+                limit_per_host=settings.get("limit_per_host", self.limit_per_host),
+                keepalive_timeout=settings.get("keepalive", 30)
+            )
+            timeout = aiohttp.ClientTimeout(total=settings.get("timeout", self.timeout))
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.sessions[host] = session
+
+        return session
+
+    async def request(self, method, url, **kwargs):
+        host = urlsplit(url).netloc
+        if host in self.limiters:
+            await self.limiters[host].acquire()
+
+        session = self._session(host)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                content = await r.read()
+                status = r.status
+                return Response(url, r.status, r.headers, content)
+        finally:
+            metrics.observe("rlmbot_http_request_duration_seconds", time.perf_counter() - start, host=host)
+            metrics.inc("rlmbot_http_requests_total", host=host, method=method, status=status)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self):
+        sessions, self.sessions = self.sessions, {}
+        await asyncio.gather(*[s.close() for s in sessions.values()], return_exceptions=True)
+
+
+def get_client(bot, config):
+    if getattr(bot, "web_client", None) is None:
+        bot.web_client = WebClient(config.get("http"), config.get("rate_limits"))
+
+    return bot.web_client